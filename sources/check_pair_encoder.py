@@ -0,0 +1,123 @@
+import sys
+import argparse
+from transformers import BertTokenizer
+from utils_relation import glue_processors as processors
+from utils_relation import PairEncoder, IDIndexDic, relation_arrays, add_entity_markers
+
+
+def encode_plus_pair(tokenizer, texts, pos_dict, e1, e2, max_length, joiner=' ', pad_token=0):
+    '''
+    padded input_ids, attention_mask and token_type_ids of the pair (e1, e2) from encode_plus on the marked text,
+    as the features were built before PairEncoder
+    '''
+    x1, x2 = pos_dict[e1]
+    y1, y2 = pos_dict[e2]
+    first, second = ('<e1>', '</e1>'), ('<e2>', '</e2>')
+    if x1 > y1:
+        x1,x2,y1,y2 = y1,y2,x1,x2
+        first, second = second, first
+    # the ACROBAT words carry their own whitespace, the markers were written with a trailing space
+    suffix = '' if joiner.isspace() else ' '
+    new_text = texts[0:x1] + [first[0] + suffix] + texts[x1:(x2+1)] + [first[1] + suffix] + texts[(x2+1):y1] + [second[0] + suffix] + texts[y1:(y2+1)] + [second[1] + suffix] + texts[(y2+1):len(texts)]
+    inputs = tokenizer.encode_plus(
+        joiner.join(new_text),
+        add_special_tokens=True,
+        max_length=max_length,
+    )
+    input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
+    attention_mask = [1] * len(input_id)
+
+    # Zero-pad up to the sequence length.
+    padding_length = max_length - len(input_id)
+    input_id = input_id + ([pad_token] * padding_length)
+    attention_mask = attention_mask + ([0] * padding_length)
+    token_type_id = token_type_id + ([0] * padding_length)
+    return input_id, attention_mask, token_type_id
+
+
+def marker_positions(tokenizer, input_id, markers):
+    '''
+    position of the token after the <e1> and <e2> marker pieces in input_id, -1 when the marker or the entity is truncated
+    '''
+    special_ids = set(tokenizer.all_special_ids)
+    node_pos = []
+    for m in ['<e1>', '<e2>']:
+        pattern = markers[m]
+        starts = [i for i in range(len(input_id)) if input_id[i:i+len(pattern)] == pattern]
+        position = starts[0] + len(pattern) if starts else len(input_id)
+        node_pos.append(position if position < len(input_id) and input_id[position] not in special_ids else -1)
+    return tuple(node_pos)
+
+
+def check_windows(examples, tokenizer, max_length, tbd = False, joiners = (' ', ''), max_windows = 100):
+    '''
+    check PairEncoder.encode against encode_plus_pair, and its node_pos against the markers of the encode_plus ids,
+    for every ordered event pair of max_windows windows spread over examples, with every joiner; returns the number
+    of pairs checked and the first pair that differs, None when all match
+    '''
+    step = max(1, -(-len(examples) // max_windows)) if max_windows else 1
+    checked = 0
+    for example in examples[::step]:
+        IDToIndex, _ = IDIndexDic(rel = example.relations)
+        _, _, _, pos_dict = relation_arrays(rel = example.relations, IDToIndex = IDToIndex, tbd = tbd)
+        if tbd:
+            texts = example.text
+        else:
+            texts = []
+            for text in example.text:
+                texts.extend(text)
+        for joiner in joiners:
+            encoder = PairEncoder(tokenizer, texts, pos_dict, max_length, joiner=joiner)
+            for e1 in pos_dict:
+                for e2 in pos_dict:
+                    if e1 == e2:
+                        continue
+                    expected = encode_plus_pair(tokenizer, texts, pos_dict, e1, e2, max_length, joiner)
+                    expected = expected + (marker_positions(tokenizer, expected[0], encoder.markers),)
+                    if tuple(encoder.encode(e1, e2)) != expected:
+                        return checked, (example.doc_id, example.sen_id, e1, e2, joiner)
+                    checked += 1
+    return checked, None
+
+
+# PairEncoder splices the marker ids into the subword ids of the window, tokenized once; this checks that the
+# spliced pairs are the ones encode_plus gives on the marked text. encode_plus only truncates from the right,
+# so the check is of --truncation right; --truncation entity has no encode_plus counterpart
+parser = argparse.ArgumentParser(description='Check the PairEncoder features against encode_plus on the marked text.')
+parser.add_argument('--data_dir', type=str, required=True,
+                    help='the directory of train.json, dev.json and test.json')
+parser.add_argument('--model_name_or_path', type=str, required=True,
+                    help='the tokenizer to check')
+parser.add_argument('--task_name', type=str, default='i2b2-g',
+                    help='the processor of the data')
+parser.add_argument('--split', type=str, default='train', choices=['train', 'dev', 'test'],
+                    help='the examples to check')
+parser.add_argument('--max_seq_length', type=int, default=128,
+                    help='the length of the pair features')
+parser.add_argument('--max_windows', type=int, default=100,
+                    help='the number of windows checked, spread over the examples (0 for all)')
+parser.add_argument('--tbd', action='store_true',
+                    help='Set this flag if you are using a TBDense data.')
+parser.add_argument('--do_lower_case', action='store_true',
+                    help='Set this flag if you are using an uncased model.')
+parser.add_argument('--entity_marker_tokens', action='store_true',
+                    help='Check with the entity markers added to the vocabulary as special tokens.')
+args = parser.parse_args()
+
+tokenizer = BertTokenizer.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case)
+if args.entity_marker_tokens:
+    add_entity_markers(tokenizer)
+processor = processors[args.task_name]()
+if args.split == 'test':
+    examples = processor.get_test_examples(args.data_dir, args.tbd)
+elif args.split == 'dev':
+    examples = processor.get_dev_examples(args.data_dir, args.tbd)
+else:
+    examples = processor.get_train_examples(args.data_dir, args.tbd)
+
+# ' ' joins the words of the plain features, '' the ACROBAT leftover edges
+checked, mismatch = check_windows(examples, tokenizer, args.max_seq_length, tbd = args.tbd, max_windows = args.max_windows)
+if mismatch is not None:
+    print('PairEncoder differs from encode_plus for doc %s sen %s pair (%s, %s) with joiner %r' % mismatch)
+    sys.exit(1)
+print('PairEncoder matches encode_plus on %d pairs' % checked)
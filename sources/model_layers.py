@@ -7,38 +7,111 @@ from torch.nn import CrossEntropyLoss, MSELoss
 import torch.nn.functional as F
 from transformers import  BertPreTrainedModel, BertModel
 import numpy as np
+from utils_relation import RULE_LABELS
 
 
-def PSL_loss( logits=None, rules = None, stick_rule = True, loss = None):
+# label of each pair of the triple (A-B, B-C, A-C) for rules 1-7; rule 0 means no rule exists
+RULE_RELATIONS = torch.from_numpy(RULE_LABELS)
+
+
+def PSL_loss( logits=None, rules = None, stick_rule = True, loss = None, valid = None):
     '''
     PSL loss, fixing true label to calculate the loss
+    logits are (3B, C) with the three pairs of each triple next to each other, rules are one rule per pair
+    a triple with a row that is not valid (valid 0) is left out
     '''
-    psl_loss = torch.tensor(0, dtype = torch.float64).cuda()
-
-    relations_dict = {
-            1: [1,1,1],
-            2: [2,2,2],
-            3: [1,0,1],
-            4: [0,2,2],
-            5: [0,1,1],
-            6: [2,0,2],
-            7: [0,0,0],
-        }
     s = nn.Softmax(1)
-    logits = s(logits)
-    
-    for n_batch in range(int(logits.size()[0]/3)):
-        rule = rules[n_batch]
-        if rule == 0:# no rule exists
+    probs = s(logits).view(-1, 3, logits.size(-1))
+    # the three pairs of a triple share its rule
+    rule = rules.view(-1, 3)[:, 0].long()
+    relation = RULE_RELATIONS.to(logits.device)[rule]
+    ijk = probs.gather(2, relation.unsqueeze(2)).squeeze(2)
+    psl_loss = torch.clamp(torch.clamp(ijk[:, 0] + ijk[:, 1] - 1, min=0) - ijk[:, 2], min=0)
+    psl_loss = psl_loss.masked_fill(rule == 0, 0)
+    if valid is not None:
+        psl_loss = psl_loss.masked_fill(~valid.to(logits.device).view(-1, 3).bool().all(1), 0)
+
+    return psl_loss.sum()
+
+def unpadded_bert(bert, input_ids, attention_mask=None, token_type_ids=None, head_mask=None, bucket_size=8):
+    '''
+    pooled output (B, H) of a BertModel run on the real tokens of the batch only
+    the real tokens of all rows are concatenated into one (T, H) sequence, row b starting at offsets[b], so the
+    embeddings, projections and feed-forward layers cost T rather than B * L rows; attention runs over each
+    row's offsets / lengths, with the rows grouped by their length rounded up to bucket_size so one matmul
+    covers a group, and costs about the sum of the squared lengths rather than B * L^2
+    head_mask is (heads,) or (layers, heads) as in BertModel
+    '''
+    batch_size, max_len = input_ids.size()
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    if token_type_ids is None:
+        token_type_ids = torch.zeros_like(input_ids)
+    # flat (B * L) position of every real token, row by row
+    index = attention_mask.reshape(-1).nonzero().squeeze(1)
+    lengths = attention_mask.long().sum(1)
+    offsets = torch.cumsum(lengths, 0) - lengths
+    positions = torch.arange(max_len, device=input_ids.device).expand(batch_size, max_len)
+    hidden = bert.embeddings(input_ids.reshape(-1)[index].unsqueeze(0),
+                             token_type_ids=token_type_ids.reshape(-1)[index].unsqueeze(0),
+                             position_ids=positions.reshape(-1)[index].unsqueeze(0)).squeeze(0)
+    buckets = _length_buckets(lengths, offsets, bucket_size)
+    if head_mask is not None:
+        head_mask = head_mask.to(hidden.dtype)
+        if head_mask.dim() == 1:
+            head_mask = head_mask.unsqueeze(0).expand(len(bert.encoder.layer), -1)
+    for i, layer in enumerate(bert.encoder.layer):
+        layer_head_mask = head_mask[i].view(1, -1, 1, 1) if head_mask is not None else None
+        hidden = _unpadded_layer(layer, hidden, buckets, layer_head_mask)
+    # the first token of each row is its [CLS]
+    return bert.pooler(hidden[offsets].unsqueeze(1))
+
+
+def _length_buckets(lengths, offsets, bucket_size=8):
+    '''
+    the rows grouped by their length rounded up to bucket_size; for every group, the (n, width) index of the
+    row tokens in the packed (T, H) sequence and the (n, width) mask of the real ones, the index past the end
+    of a row repeats its last token
+    '''
+    widths = (lengths + bucket_size - 1) // bucket_size * bucket_size
+    buckets = []
+    for width in torch.unique(widths).tolist():
+        if width == 0:
             continue
-        relation = relations_dict[int(rule)]
-        i = logits[n_batch*3+0,relation[0]]
-        j = logits[n_batch*3+1,relation[1]]
-        k = logits[n_batch*3+2,relation[2]]
-        psl_loss = psl_loss + max(0, max(0,i+j-1)-k)
+        rows = (widths == width).nonzero().squeeze(1)
+        steps = torch.arange(width, device=lengths.device).unsqueeze(0)
+        real = steps < lengths[rows].unsqueeze(1)
+        tokens = offsets[rows].unsqueeze(1) + torch.min(steps, lengths[rows].unsqueeze(1) - 1)
+        buckets.append((tokens, real))
+    return buckets
+
+
+def _unpadded_layer(layer, hidden, buckets, head_mask=None):
+    '''
+    one BertLayer over the (T, H) packed tokens, attention within each row of _length_buckets
+    '''
+    attention = layer.attention.self
+    heads, head_size = attention.num_attention_heads, attention.attention_head_size
+    query, key, value = attention.query(hidden), attention.key(hidden), attention.value(hidden)
+
+    context = hidden.new_zeros(hidden.size(0), heads * head_size)
+    for tokens, real in buckets:
+        n, width = tokens.size()
+
+        def split(x):
+            return x[tokens].view(n, width, heads, head_size).permute(0, 2, 1, 3)
+
+        scores = torch.matmul(split(query), split(key).transpose(-1, -2)) / math.sqrt(head_size)
+        scores = scores + (1.0 - real[:, None, None, :].to(scores.dtype)) * -10000.0
+        probs = attention.dropout(F.softmax(scores, dim=-1))
+        if head_mask is not None:
+            probs = probs * head_mask
+        rows = torch.matmul(probs, split(value)).permute(0, 2, 1, 3).reshape(n * width, -1)
+        # every real token is a query of exactly one bucket
+        context = context.index_copy(0, tokens[real], rows[real.reshape(-1)])
+    attention_output = layer.attention.output(context, hidden)
+    return layer.output(layer.intermediate(attention_output), attention_output)
 
-    
-    return psl_loss
 
 def identify_label(label1 = None, label2 = None):
     ruleB = [(1,1),(1,0),(0,1)]
@@ -58,6 +131,13 @@ def identify_label(label1 = None, label2 = None):
 class BertForRelationClassification(BertPreTrainedModel):
     '''
     for relation classification with psl loss
+    with unpad the encoder runs on the real tokens only (unpadded_bert); hidden states and attentions are
+    then not returned
+    with segment_index the rows hold several packed pairs, each with its own [CLS] and position ids restarted
+    at 0 and a (R, L, L) block-diagonal attention_mask; segment_index (N, 2) is the (row, start) of every pair
+    and the logits come out one per pair in segment_index order
+    valid (N,) marks the rows that only fill up a triple of leftover edges with 0; they are not encoded and
+    are left out of the loss, their logits are the classifier bias; pass it as the host tensor of the batch
     '''
     def __init__(self, config):
         super().__init__(config)
@@ -68,19 +148,40 @@ class BertForRelationClassification(BertPreTrainedModel):
         self.init_weights()
 
     def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, node_pos_ids=None, psllda = None,
-                position_ids=None, head_mask=None, inputs_embeds=None, labels=None, rules = None, evaluate = False, class_weights = [1,1,1,1,1]):
+                position_ids=None, head_mask=None, inputs_embeds=None, labels=None, rules = None, evaluate = False, class_weights = [1,1,1,1,1],
+                unpad = False, segment_index = None, valid = None):
 
-        outputs = self.bert(input_ids,
-                            attention_mask=attention_mask,
-                            token_type_ids=token_type_ids,
-                            position_ids=position_ids,
-                            head_mask=head_mask,
-                            inputs_embeds=inputs_embeds)
+        keep = None
+        if valid is not None:
+            # valid comes from the host, so the rows to keep are found without waiting on the device
+            keep = valid.nonzero().squeeze(1).to(input_ids.device)
+            if segment_index is None:
+                # packed rows already leave the invalid pairs out
+                input_ids, attention_mask, token_type_ids, position_ids = [t[keep] if t is not None else None
+                    for t in [input_ids, attention_mask, token_type_ids, position_ids]]
+
+        if unpad:
+            outputs = (None, unpadded_bert(self.bert, input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids,
+                                           head_mask=head_mask))
+        else:
+            outputs = self.bert(input_ids,
+                                attention_mask=attention_mask,
+                                token_type_ids=token_type_ids,
+                                position_ids=position_ids,
+                                head_mask=head_mask,
+                                inputs_embeds=inputs_embeds)
 
         pooled_output = outputs[1] # (8, 768)
+        if segment_index is not None:
+            # pool every packed pair from its own [CLS]
+            index = segment_index if keep is None else segment_index[keep]
+            pooled_output = self.bert.pooler(outputs[0][index[:, 0], index[:, 1]].unsqueeze(1))
+        if keep is not None:
+            # scatter the encoded rows back so the logits stay aligned with the triples
+            pooled_output = pooled_output.new_zeros((valid.size(0), pooled_output.size(-1))).index_copy(0, keep, pooled_output)
 
         # for class imbalanced
-        class_weights = torch.tensor([float(cw) for cw in class_weights]).cuda()
+        class_weights = torch.tensor([float(cw) for cw in class_weights], device=pooled_output.device)
  
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
@@ -91,11 +192,75 @@ class BertForRelationClassification(BertPreTrainedModel):
         lda = psllda
         if labels is not None: #and not evaluate: TODO
             loss_fct = CrossEntropyLoss()#weight=class_weights) 
-            loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            if keep is not None:
+                loss = loss_fct(logits[keep], labels.view(-1)[keep])
+            else:
+                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
             if psl_loss and not evaluate:
-                loss = loss  + lda * PSL_loss(logits=logits, rules = rules,loss = loss)
+                loss = loss  + lda * PSL_loss(logits=logits, rules = rules,loss = loss, valid = valid)
             outputs = (loss,) + outputs
 
 
         return outputs  # (loss), logits, (hidden_states), (attentions)
 
+
+
+class BertForMultiPairRelationClassification(BertPreTrainedModel):
+    '''
+    for relation classification of every pair of a window from one encoder pass, with psl loss on the triples
+    the window is encoded without entity markers; each entity is the mean of its span tokens and a pair
+    is classified from [CLS; e1; e2; e1 * e2]
+    '''
+    def __init__(self, config):
+        super().__init__(config)
+        self.num_labels = config.num_labels
+        self.bert = BertModel(config)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.pair_dense = nn.Linear(4 * config.hidden_size, config.hidden_size)
+        self.classifier = nn.Linear(config.hidden_size, self.config.num_labels)
+        self.init_weights()
+
+    def pool_entities(self, sequence_output, entity_spans):
+        '''
+        mean of the token states of each (start, end) span, (W, E, 2) -> (W, E, H); truncated entities are zero
+        '''
+        positions = torch.arange(sequence_output.size(1), device=sequence_output.device)
+        span_mask = (positions >= entity_spans[:, :, :1]) & (positions < entity_spans[:, :, 1:])
+        span_mask = span_mask.to(sequence_output.dtype)
+        counts = span_mask.sum(-1, keepdim=True).clamp(min=1)
+        return torch.bmm(span_mask, sequence_output) / counts
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, entity_spans=None, pair_index=None,
+                triple_index=None, psllda = None, position_ids=None, head_mask=None, inputs_embeds=None, labels=None,
+                rules = None, evaluate = False):
+        '''
+        input_ids etc. are (W, L) windows, entity_spans (W, E, 2), pair_index (P, 3) rows of (window, e1, e2),
+        triple_index (T, 3) the (A-B, B-C, A-C) rows of pair_index and rules (T,) their rule
+        '''
+        outputs = self.bert(input_ids,
+                            attention_mask=attention_mask,
+                            token_type_ids=token_type_ids,
+                            position_ids=position_ids,
+                            head_mask=head_mask,
+                            inputs_embeds=inputs_embeds)
+
+        sequence_output, pooled_output = outputs[:2]
+        entities = self.pool_entities(sequence_output, entity_spans)
+        window, e1, e2 = pair_index[:, 0], pair_index[:, 1], pair_index[:, 2]
+        h1 = entities[window, e1]
+        h2 = entities[window, e2]
+        pair_output = torch.cat([pooled_output[window], h1, h2, h1 * h2], dim=-1)
+        pair_output = torch.tanh(self.pair_dense(self.dropout(pair_output)))
+        logits = self.classifier(self.dropout(pair_output))
+        outputs = (logits,) + outputs[2:]  # add hidden states and attention if they are here
+
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            if not evaluate and triple_index is not None and triple_index.size(0) > 0:
+                # the three pairs of a triple are next to each other, as in the triple features
+                triple_logits = logits[triple_index.view(-1)]
+                loss = loss + psllda * PSL_loss(logits=triple_logits, rules = rules.repeat_interleave(3), loss = loss)
+            outputs = (loss,) + outputs
+
+        return outputs  # (loss), logits, (hidden_states), (attentions)
@@ -0,0 +1,164 @@
+'''
+Bit-packed 0/1 relation matrices.
+
+Row i of an n*n relation is packed into ceil(n / 64) uint64 words, bit j % 64 of word j // 64 is set when
+the relation holds from event i to event j. Union and intersection are word-level OR / AND and the
+boolean product ORs whole packed rows, so a relation takes 1/64 of a float64 matrix.
+'''
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+
+class RelationMatrix(object):
+    '''
+    n*n 0/1 relation with every row packed into uint64 words
+
+    Args:
+        words: (n, ceil(n / 64)) uint64 array, bit j % 64 of words[i, j // 64] is the pair (i, j);
+            the bits past column n are always zero
+        n: number of events
+    '''
+    def __init__(self, words, n):
+        self.words = words
+        self.n = n
+
+    @staticmethod
+    def n_words(n):
+        return (n + 63) // 64
+
+    @classmethod
+    def zeros(cls, n):
+        return cls(np.zeros((n, cls.n_words(n)), dtype=np.uint64), n)
+
+    @classmethod
+    def from_dense(cls, M):
+        '''
+        the pairs where M > 0
+        '''
+        n = M.shape[0]
+        packed = np.packbits(M > 0, axis=1, bitorder='little')
+        padded = np.zeros((n, 8 * cls.n_words(n)), dtype=np.uint8)
+        padded[:, :packed.shape[1]] = packed
+        return cls(padded.view('<u8').astype(np.uint64, copy=False), n)
+
+    @classmethod
+    def from_pairs(cls, n, rows, cols):
+        '''
+        the pairs (rows[i], cols[i])
+        '''
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        rel = cls.zeros(n)
+        np.bitwise_or.at(rel.words, (rows, cols >> 6), np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64)))
+        return rel
+
+    @classmethod
+    def from_bitsets(cls, bitsets, n):
+        '''
+        row i from the python integer bitsets[i], bit j is the pair (i, j)
+        '''
+        n_bytes = 8 * cls.n_words(n)
+        buf = b''.join(bits.to_bytes(n_bytes, 'little') for bits in bitsets)
+        words = np.frombuffer(buf, dtype='<u8').astype(np.uint64).reshape(len(bitsets), cls.n_words(n))
+        return cls(words, n)
+
+    def to_bool(self):
+        bits = np.unpackbits(self.words.astype('<u8', copy=False).view(np.uint8), axis=1, bitorder='little')
+        return bits[:, :self.n].astype(bool)
+
+    def to_dense(self, dtype=np.float64):
+        return self.to_bool().astype(dtype)
+
+    @property
+    def T(self):
+        '''
+        transpose on the packed words: every 64 * 64 block of bits is transposed in place and block (i, j)
+        moves to (j, i), so no dense n*n matrix is built
+        '''
+        n_words = self.words.shape[1]
+        full = np.zeros((64 * n_words, n_words), dtype=np.uint64)
+        full[:self.n] = self.words
+        # (row block, column block, 64 rows) -> one row of 64 words per block
+        blocks = full.reshape(n_words, 64, n_words).transpose(0, 2, 1).reshape(-1, 64)
+        blocks = _transpose_blocks(blocks)
+        # word c of block (i, j) is row 64 * j + c, word i of the transpose
+        words = blocks.reshape(n_words, n_words, 64).transpose(1, 2, 0).reshape(64 * n_words, n_words)
+        return RelationMatrix(np.ascontiguousarray(words[:self.n]), self.n)
+
+    def __or__(self, other):
+        return RelationMatrix(self.words | other.words, self.n)
+
+    def __and__(self, other):
+        return RelationMatrix(self.words & other.words, self.n)
+
+    def __invert__(self):
+        words = ~self.words
+        if self.n % 64:
+            words[:, -1] &= np.uint64((1 << (self.n % 64)) - 1)
+        return RelationMatrix(words, self.n)
+
+    def __matmul__(self, other):
+        '''
+        boolean product, (i, k) is set when (i, j) is set in self and (j, k) in other for some j
+        '''
+        out = RelationMatrix.zeros(self.n)
+        rows, cols = self.nonzero()
+        if rows.size:
+            # rows come out sorted, so each row of the product ORs one contiguous run of rows of other
+            starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+            out.words[rows[starts]] = np.bitwise_or.reduceat(other.words[cols], starts, axis=0)
+        return out
+
+    def __eq__(self, other):
+        return self.n == other.n and np.array_equal(self.words, other.words)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def any(self):
+        return bool(self.words.any())
+
+    def count(self):
+        return int(np.unpackbits(self.words.view(np.uint8)).sum())
+
+    def nonzero(self):
+        '''
+        rows and columns of the set pairs, in the order of np.nonzero; only the non-empty words are unpacked
+        '''
+        word_rows, word_cols = np.nonzero(self.words)
+        bits = np.unpackbits(self.words[word_rows, word_cols].astype('<u8').view(np.uint8).reshape(-1, 8),
+                             axis=1, bitorder='little')
+        index, bit = np.nonzero(bits)
+        return word_rows[index], word_cols[index] * 64 + bit
+
+    def get(self, rows, cols):
+        '''
+        whether each pair (rows[i], cols[i]) is set
+        '''
+        cols = np.asarray(cols, dtype=np.int64)
+        words = self.words[rows, cols >> 6]
+        return ((words >> (cols & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+    def diagonal(self):
+        index = np.arange(self.n)
+        return self.get(index, index)
+
+
+def _transpose_blocks(blocks):
+    '''
+    transpose every 64 * 64 bit block of (k, 64) uint64 words, bit c of word r going to bit r of word c; the
+    quadrants off the diagonal are swapped at half widths 32, 16, ..., 1 (Hacker's Delight 7-3)
+    '''
+    blocks = blocks.copy()
+    width, mask = 32, np.uint64(0x00000000FFFFFFFF)
+    rows = np.arange(64)
+    while width:
+        top = rows[(rows & width) == 0]
+        shift = np.uint64(width)
+        a, b = blocks[:, top], blocks[:, top + width]
+        swap = ((a >> shift) ^ b) & mask
+        blocks[:, top] = a ^ (swap << shift)
+        blocks[:, top + width] = b ^ swap
+        width //= 2
+        mask ^= mask << np.uint64(width)
+    return blocks
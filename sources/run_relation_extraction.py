@@ -7,8 +7,9 @@ import random
 import sys
 import numpy as np 
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
+from torch.utils.data import (DataLoader, Dataset, RandomSampler, Sampler, SequentialSampler,
                               TensorDataset)
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from closure import evaluation as closure_evaluate
 try:
@@ -32,12 +33,15 @@ from transformers import (WEIGHTS_NAME, BertConfig,
                                   AlbertForSequenceClassification, 
                                   AlbertTokenizer,
                                 )
-from model_layers import BertForRelationClassification
+from model_layers import BertForRelationClassification, BertForMultiPairRelationClassification
 from transformers import AdamW, get_linear_schedule_with_warmup
 from utils_relation import glue_compute_metrics as compute_metrics
 from utils_relation import glue_output_modes as output_modes
 from utils_relation import glue_processors as processors
 from utils_relation import sb_convert_examples_to_features as convert_examples_to_features
+from utils_relation import features_to_columns, save_feature_cache, load_feature_cache, feature_cache_key
+from utils_relation import window_closure, save_closure_cache, load_closure_cache, add_entity_markers
+from utils_relation import window_convert_examples_to_features, window_features_to_columns
 
 
 logger = logging.getLogger(__name__)
@@ -46,9 +50,13 @@ ALL_MODELS = sum((tuple(conf.pretrained_config_archive_map.keys()) for conf in (
                                                                                 RobertaConfig, DistilBertConfig)), ())
 
 MODEL_CLASSES = {
-    'bert': (BertConfig, BertForRelationClassification, BertTokenizer)
+    'bert': (BertConfig, BertForRelationClassification, BertTokenizer),
+    'bert-window': (BertConfig, BertForMultiPairRelationClassification, BertTokenizer),
 }
 
+# model types that encode a window once and classify all of its pairs, see WindowDataset
+WINDOW_MODEL_TYPES = ['bert-window']
+
 
 def set_seed(args):
     random.seed(args.seed)
@@ -58,6 +66,345 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
+class WindowDataset(Dataset):
+    """
+    Context windows for the shared-encoder models. An item is a window; ``collate`` gathers the windows
+    of a batch with all of their pairs and triples, re-indexed to the batch.
+
+    Args:
+        columns: the columns of ``window_features_to_columns``
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.num_pairs = len(columns['labels'])
+        self.lengths = columns['lengths']
+
+    def __len__(self):
+        return len(self.columns['input_ids'])
+
+    def __getitem__(self, index):
+        return index
+
+    def collate(self, indices):
+        c = self.columns
+        windows = np.asarray(indices)
+        pair_start, pair_end = c['pair_offsets'][windows], c['pair_offsets'][windows + 1]
+        triple_start, triple_end = c['triple_offsets'][windows], c['triple_offsets'][windows + 1]
+        pair_rows = np.concatenate([np.arange(a, b) for a, b in zip(pair_start, pair_end)])
+        triple_rows = np.concatenate([np.arange(a, b) for a, b in zip(triple_start, triple_end)])
+        pair_window = np.repeat(np.arange(len(windows)), pair_end - pair_start)
+        # the triples of a window index its pairs, which start at batch_start in the batch
+        batch_start = np.cumsum(pair_end - pair_start) - (pair_end - pair_start)
+        triple_shift = np.repeat(batch_start - pair_start, triple_end - triple_start)
+        events = c['event_ids'][pair_rows]
+        # the windows are padded on the right, so the batch is cut to its longest window
+        max_len = int(c['lengths'][windows].max())
+        batch = {
+            'input_ids': c['input_ids'][windows, :max_len],
+            'attention_mask': c['attention_mask'][windows, :max_len],
+            'token_type_ids': c['token_type_ids'][windows, :max_len],
+            'entity_spans': c['entity_spans'][windows],
+            'pair_index': np.stack([pair_window, events[:, 0], events[:, 1]], axis=1),
+            'labels': c['labels'][pair_rows],
+            'triple_index': c['triple_pairs'][triple_rows] + triple_shift[:, None],
+            'rules': c['rules'][triple_rows],
+            'event_ids': events,
+            'doc_ids': c['doc_ids'][windows][pair_window],
+            'sen_ids': c['sen_ids'][windows][pair_window],
+        }
+        return {name: torch.from_numpy(np.asarray(value, dtype=np.int64)) for name, value in batch.items()}
+
+
+class TripleDataset(Dataset):
+    """
+    Training triples over a table of distinct pairs. An item is a triple; ``collate`` gathers the three
+    pair rows of every triple of a batch from the table, so a pair shared by many triples is stored once.
+    The batch is the tuple of a pair TensorDataset, in the order of ``pair_columns``.
+
+    Args:
+        columns: the training columns of ``features_to_columns``
+        trim: cut input_ids, attention_mask and token_type_ids to the longest row of the batch
+    """
+    def __init__(self, columns, trim = False):
+        self.columns = columns
+        self.trim = trim
+        # a triple is as long as its longest pair
+        self.lengths = columns['lengths'][columns['triple_pairs']].max(axis = 1)
+
+    def __len__(self):
+        return len(self.columns['triple_pairs'])
+
+    def __getitem__(self, index):
+        return index
+
+    def collate(self, indices):
+        c = self.columns
+        indices = np.asarray(indices)
+        rows = c['triple_pairs'][indices]
+        max_len = int(c['lengths'][rows].max()) if self.trim else c['input_ids'].shape[1]
+        batch = []
+        for name in pair_columns():
+            if name in ['input_ids', 'attention_mask', 'token_type_ids']:
+                batch.append(c[name][:, :max_len][rows])
+            elif name == 'lengths':
+                batch.append(c[name][rows])
+            else:
+                batch.append(c[name][indices])
+        return tuple(torch.from_numpy(np.ascontiguousarray(value)) for value in batch)
+
+
+def trim_collate(rows):
+    '''
+    collate rows of a pair TensorDataset whose last tensor holds the lengths, cutting input_ids,
+    attention_mask and token_type_ids to the longest row of the batch
+    '''
+    batch = default_collate(rows)
+    max_len = int(batch[-1].max())
+    return tuple(t[..., :max_len] if i < 3 else t for i, t in enumerate(batch))
+
+
+def pair_columns(evaluate = False):
+    '''
+    names of the tensors of a pair TensorDataset or a TripleDataset batch, in order; rules and valid only exist
+    for the training triples and lengths stays last, trim_collate reads it there
+    '''
+    names = ['input_ids', 'attention_mask', 'token_type_ids', 'event_ids', 'labels', 'doc_ids', 'sen_ids']
+    if not evaluate:
+        names.extend(['rules', 'valid'])
+    return names + ['lengths']
+
+
+def pack_segments(lengths, width):
+    '''
+    first-fit decreasing placement of sequences of the given lengths into rows of width tokens; the
+    (row, start) of every sequence and the number of rows
+    '''
+    placement = np.zeros((len(lengths), 2), dtype = np.int64)
+    free = []
+    for index in np.argsort(-lengths, kind = 'stable'):
+        length = int(lengths[index])
+        row = next((r for r, space in enumerate(free) if space >= length), len(free))
+        if row == len(free):
+            free.append(width)
+        placement[index] = row, width - free[row]
+        free[row] -= length
+    return placement, len(free)
+
+
+class PairPacker(object):
+    """
+    Collate function packing the pairs of a batch of a pair TensorDataset into as few rows of
+    ``max_seq_length`` tokens as they fit in. Every pair keeps its own [CLS] ... [SEP] and restarts its
+    position ids at 0, and attends to its own tokens only through a (R, L, L) block-diagonal attention mask.
+    The three rows of a training triple become three pairs in a row of the output, so the pair tensors
+    (labels, rules, ...) keep the (3B,) order ``PSL_loss`` expects, and ``segment_index`` gives the
+    (row, start) of each pair. Pairs that are not ``valid`` take no tokens.
+
+    Args:
+        names: the tensors of the dataset, ``pair_columns``
+        gather: collate function building the batch tuple from the items, ``TripleDataset.collate`` for triples
+    """
+    def __init__(self, names, gather = default_collate):
+        self.names = names
+        self.gather = gather
+
+    def __call__(self, rows):
+        batch = dict(zip(self.names, self.gather(rows)))
+        width = batch['input_ids'].size(-1)
+        lengths = batch['lengths'].reshape(-1)
+        if 'valid' in batch:
+            lengths = lengths * batch['valid'].reshape(-1).to(lengths.dtype)
+        n_pairs = lengths.size(0)
+        placement, n_rows = pack_segments(lengths.numpy(), width)
+
+        flat = {name: batch[name].reshape(n_pairs, width) for name in ['input_ids', 'token_type_ids']}
+        packed = {name: torch.zeros((n_rows, width), dtype=torch.long) for name in ['input_ids', 'token_type_ids', 'position_ids']}
+        segment = torch.zeros((n_rows, width), dtype=torch.long)
+        for index, ((row, start), length) in enumerate(zip(placement, lengths.tolist())):
+            packed['input_ids'][row, start:start + length] = flat['input_ids'][index, :length]
+            packed['token_type_ids'][row, start:start + length] = flat['token_type_ids'][index, :length]
+            packed['position_ids'][row, start:start + length] = torch.arange(length)
+            segment[row, start:start + length] = index + 1
+        # a token attends to the tokens of its own pair; padding belongs to no pair
+        packed['attention_mask'] = ((segment[:, :, None] == segment[:, None, :]) & (segment[:, :, None] > 0)).long()
+        packed['segment_index'] = torch.from_numpy(placement)
+        for name in self.names:
+            if name not in ['input_ids', 'attention_mask', 'token_type_ids', 'lengths']:
+                packed[name] = batch[name].long().reshape(n_pairs, -1).squeeze(1)
+        return packed
+
+
+def dataset_collate(args, dataset, evaluate = False, trim = False):
+    '''
+    collate function of a loader over dataset; trim cuts unpacked pair batches to their longest row
+    '''
+    if isinstance(dataset, WindowDataset):
+        return dataset.collate
+    if isinstance(dataset, TripleDataset):
+        # packing keeps the full width of the rows
+        dataset.trim = trim and not args.pack_pairs
+        return PairPacker(pair_columns(evaluate), dataset.collate) if args.pack_pairs else dataset.collate
+    if args.pack_pairs:
+        return PairPacker(pair_columns(evaluate))
+    return trim_collate if trim else None
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batches of items of similar length, each holding as many items as fit in a token budget once the
+    batch is padded to its longest item.
+
+    For training the items are shuffled, sorted by length within pools of about ``pool_batches`` batches
+    and the batches are shuffled again, so every epoch sees different batches of similar length. For
+    evaluation the items are sorted longest first and the batches kept in that order.
+
+    Args:
+        lengths: number of real tokens of every item; for an item of several rows, the longest row
+        max_tokens: budget on rows * longest length of a batch; an item over the budget makes a batch alone
+        rows_per_item: rows the model sees for one item, 3 for the training triples
+        shuffle: training order when True, longest first when False
+        pool_batches: number of batches' worth of items sorted together when shuffling
+    """
+    def __init__(self, lengths, max_tokens, rows_per_item = 1, shuffle = True, pool_batches = 100):
+        self.lengths = np.asarray(lengths, dtype = np.int64)
+        self.max_tokens = max_tokens
+        self.rows_per_item = rows_per_item
+        self.shuffle = shuffle
+        mean_length = max(float(self.lengths.mean()), 1.0) if len(self.lengths) else 1.0
+        self.pool_size = max(1, int(pool_batches * max_tokens / (rows_per_item * mean_length)))
+        self.plan = None
+
+    def _batches(self, order):
+        '''
+        cut the items in order into batches under the token budget
+        '''
+        batches, batch, longest = [], [], 0
+        for index in order:
+            length = max(int(self.lengths[index]), 1)
+            if batch and (len(batch) + 1) * self.rows_per_item * max(longest, length) > self.max_tokens:
+                batches.append(batch)
+                batch, longest = [], 0
+            batch.append(int(index))
+            longest = max(longest, length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _plan(self):
+        if not self.shuffle:
+            return self._batches(np.argsort(-self.lengths, kind = 'stable'))
+        order = np.random.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start + self.pool_size]
+            batches.extend(self._batches(pool[np.argsort(self.lengths[pool], kind = 'stable')]))
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def __iter__(self):
+        # the plan made by __len__ for the coming epoch is used once, later epochs draw a new one
+        plan = self.plan if self.plan is not None else self._plan()
+        self.plan = None
+        return iter(plan)
+
+    def __len__(self):
+        if self.plan is None:
+            self.plan = self._plan()
+        return len(self.plan)
+
+
+def length_batch_sampler(dataset, max_tokens, shuffle = True):
+    '''
+    a TokenBudgetBatchSampler over a WindowDataset, a TripleDataset or a pair TensorDataset ending with its
+    lengths; the three rows of a training triple are one item, so a triple is never split
+    '''
+    if isinstance(dataset, WindowDataset):
+        return TokenBudgetBatchSampler(dataset.lengths, max_tokens, shuffle = shuffle)
+    if isinstance(dataset, TripleDataset):
+        return TokenBudgetBatchSampler(dataset.lengths, max_tokens, rows_per_item = 3, shuffle = shuffle)
+    lengths = dataset.tensors[-1].numpy()
+    rows_per_item = lengths.shape[1] if lengths.ndim == 2 else 1
+    if lengths.ndim == 2:
+        lengths = lengths.max(axis = 1)
+    return TokenBudgetBatchSampler(lengths, max_tokens, rows_per_item = rows_per_item, shuffle = shuffle)
+
+
+class EvalContext(object):
+    """
+    The evaluation dataset and loader of one task together with its ``dict_IndenToID`` and ``label_dict``,
+    built once so that repeated ``evaluate`` calls only run the forward passes.
+
+    Args:
+        final_evaluate: load the test data instead of the dev data.
+        sort_by_length: order the rows by sequence length, longest first, so each batch can be cut to
+            its longest sequence. ``order`` maps the sorted rows back to the dataset order.
+        max_batch_tokens: when > 0, batch by length under this token budget (``TokenBudgetBatchSampler``)
+            instead of ``eval_batch_size`` rows; ``order`` then holds the rows in loader order.
+    """
+    def __init__(self, args, task, tokenizer, final_evaluate = False, sort_by_length = False, max_batch_tokens = 0):
+        self.task = task
+        self.final_evaluate = final_evaluate
+        dataset, self.dict_IndenToID, self.label_dict = load_and_cache_examples(args, task, tokenizer, evaluate=True, final_evaluate = final_evaluate)
+        self.order = None
+        args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+        if max_batch_tokens > 0 and args.local_rank == -1:
+            batch_sampler = length_batch_sampler(dataset, max_batch_tokens, shuffle = False)
+            self.dataset = dataset
+            self.dataloader = DataLoader(dataset, batch_sampler=batch_sampler,
+                                         collate_fn=dataset_collate(args, dataset, evaluate = True, trim = True))
+            self.num_examples = dataset.num_pairs if isinstance(dataset, WindowDataset) else len(dataset)
+            # rows come out longest first; the pairs of a window batch follow its windows
+            order = np.concatenate([np.asarray(batch) for batch in batch_sampler])
+            if isinstance(dataset, WindowDataset):
+                offsets = dataset.columns['pair_offsets']
+                order = np.concatenate([np.arange(offsets[w], offsets[w + 1]) for w in order])
+            self.order = order
+            return
+        # a window batch holds a varying number of pairs, so only the pair datasets are sorted
+        if sort_by_length and isinstance(dataset, TensorDataset):
+            lengths = dataset.tensors[1].numpy().sum(axis=-1)
+            self.order = np.argsort(-lengths, kind='stable')
+            index = torch.from_numpy(self.order)
+            dataset = TensorDataset(*[t[index] for t in dataset.tensors])
+        self.dataset = dataset
+
+        # Note that DistributedSampler samples randomly
+        eval_sampler = SequentialSampler(dataset) if args.local_rank == -1 else DistributedSampler(dataset)
+        self.dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=dataset_collate(args, dataset, evaluate = True))
+        self.num_examples = dataset.num_pairs if isinstance(dataset, WindowDataset) else len(eval_sampler)
+
+    def restore_order(self, array):
+        '''
+        put rows collected in loader order back in dataset order
+        '''
+        if self.order is None:
+            return array
+        return array[np.argsort(self.order)]
+
+
+class EvalCollector(object):
+    """
+    Buffers for the evaluation outputs, allocated once with one row per evaluated example and filled
+    by slice. They live on the device of the first batch and are copied to the host once in ``finalize``.
+    """
+    def __init__(self, num_examples):
+        self.num_examples = num_examples
+        self.count = 0
+        self.buffers = {}
+
+    def add(self, **tensors):
+        n_rows = None
+        for name, tensor in tensors.items():
+            if name not in self.buffers:
+                self.buffers[name] = torch.empty((self.num_examples,) + tuple(tensor.size()[1:]), dtype=tensor.dtype, device=tensor.device)
+            n_rows = tensor.size(0)
+            self.buffers[name][self.count:self.count + n_rows] = tensor
+        self.count += n_rows
+
+    def finalize(self):
+        return {name: buffer[:self.count].cpu().numpy() for name, buffer in self.buffers.items()}
+
+
 def train(args, train_dataset, model, tokenizer, dict_IndenToID, label_dict):
     """ Train the model """
     # keep track of the best f1
@@ -69,10 +416,21 @@ def train(args, train_dataset, model, tokenizer, dict_IndenToID, label_dict):
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if args.max_batch_tokens > 0 and args.local_rank == -1:
+        train_sampler = length_batch_sampler(train_dataset, args.max_batch_tokens, shuffle = True)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler,
+                                      collate_fn=dataset_collate(args, train_dataset, trim = True))
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,
+                                      collate_fn=dataset_collate(args, train_dataset))
 
     #results = evaluate(args, model, tokenizer)
+    eval_context = None
+    if args.local_rank == -1 and args.evaluate_during_training:
+        # the dev set stays resident for every evaluation of the run
+        eval_context = EvalContext(args, args.task_name, tokenizer, sort_by_length = args.eval_sort_by_length,
+                                   max_batch_tokens = args.max_batch_tokens)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -125,20 +483,36 @@ def train(args, train_dataset, model, tokenizer, dict_IndenToID, label_dict):
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
         for step, batch in enumerate(epoch_iterator):
             model.train()
-            # convert the example from three cases one example to one case one exsample
-            batch = tuple(t.view(-1).to(args.device) if len(t.size()) ==2 else t.view(t.size()[0]*t.size()[1],-1).to(args.device) for t in batch) 
-            class_weights = args.class_weight.split('~')
-            inputs = {'input_ids':      batch[0],
-                        'attention_mask': batch[1],
-                        'labels':         batch[4],
-                        'rules':          batch[7],
-                        'psllda':         args.psllda,
-                        'class_weights':  class_weights,
-                        }
-
-
-            if args.model_type != 'distilbert':
-                inputs['token_type_ids'] = batch[2] if args.model_type in ['bert', 'xlnet'] else None  # XLM, DistilBERT and RoBERTa don't use segment_ids
+            if args.model_type in WINDOW_MODEL_TYPES:
+                batch = {name: t.to(args.device) for name, t in batch.items()}
+                inputs = window_inputs(batch, args)
+            elif args.pack_pairs:
+                # valid stays on the host, the model finds the rows to encode from it
+                valid = batch['valid']
+                batch = {name: t.to(args.device) for name, t in batch.items()}
+                inputs = packed_inputs(batch, args)
+                inputs['rules'] = batch['rules']
+                inputs['valid'] = valid
+                inputs['class_weights'] = args.class_weight.split('~')
+            else:
+                # valid stays on the host, the model finds the rows to encode from it
+                valid = batch[8].view(-1)
+                # convert the example from three cases one example to one case one exsample
+                batch = tuple(t.view(-1).to(args.device).long() if len(t.size()) ==2 else t.view(t.size()[0]*t.size()[1],-1).to(args.device).long() for t in batch) 
+                class_weights = args.class_weight.split('~')
+                inputs = {'input_ids':      batch[0],
+                            'attention_mask': batch[1],
+                            'labels':         batch[4],
+                            'rules':          batch[7],
+                            'valid':          valid,
+                            'psllda':         args.psllda,
+                            'class_weights':  class_weights,
+                            'unpad':          args.unpadded_encoder,
+                            }
+
+
+                if args.model_type != 'distilbert':
+                    inputs['token_type_ids'] = batch[2] if args.model_type in ['bert', 'xlnet'] else None  # XLM, DistilBERT and RoBERTa don't use segment_ids
             outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
 
@@ -168,7 +542,7 @@ def train(args, train_dataset, model, tokenizer, dict_IndenToID, label_dict):
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
                     # Log metrics
                     if args.local_rank == -1 and args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
-                        best_mif1, best_maf1, best_check, results = evaluate(best_mif1, best_maf1,best_check,global_step, args, model, tokenizer, final_evaluate = False)
+                        best_mif1, best_maf1, best_check, results = evaluate(best_mif1, best_maf1,best_check,global_step, args, model, tokenizer, final_evaluate = False, eval_context = eval_context)
                         best_f1s.append((global_step,best_mif1))
 
                     tb_writer.add_scalar('lr', scheduler.get_lr()[0], global_step)
@@ -205,9 +579,32 @@ def train(args, train_dataset, model, tokenizer, dict_IndenToID, label_dict):
     return global_step, tr_loss / global_step, best_check
 
 
-def evaluate(best_mif1, best_maf1, best_check, check,  args, model, tokenizer,  prefix="", final_evaluate = False):
+def window_inputs(batch, args, evaluate = False):
+    '''
+    model inputs of a WindowDataset batch already on the device
+    '''
+    inputs = {name: batch[name] for name in ['input_ids', 'attention_mask', 'token_type_ids', 'entity_spans',
+                                             'pair_index', 'labels', 'triple_index', 'rules']}
+    inputs['psllda'] = args.psllda
+    inputs['evaluate'] = evaluate
+    return inputs
+
+
+def packed_inputs(batch, args, evaluate = False):
+    '''
+    model inputs of a PairPacker batch already on the device
+    '''
+    inputs = {name: batch[name] for name in ['input_ids', 'attention_mask', 'token_type_ids', 'position_ids',
+                                             'segment_index', 'labels']}
+    inputs['psllda'] = args.psllda
+    inputs['evaluate'] = evaluate
+    return inputs
+
+
+def evaluate(best_mif1, best_maf1, best_check, check,  args, model, tokenizer,  prefix="", final_evaluate = False, eval_context = None):
     '''
     evaluate on the dev or test data, update best f1 score 
+    eval_context is an EvalContext to reuse, otherwise one is built for this call
     '''
     softmax = torch.nn.Softmax(dim=1)
     # Loop to handle MNLI double evaluation (matched, mis-matched)
@@ -216,16 +613,17 @@ def evaluate(best_mif1, best_maf1, best_check, check,  args, model, tokenizer,
 
     results = {}
     for eval_task, eval_output_dir in zip(eval_task_names, eval_outputs_dirs):
-        eval_dataset, dict_IndenToID, label_dict = load_and_cache_examples(args, eval_task, tokenizer, evaluate=True, final_evaluate = final_evaluate)
+        if eval_context is None or eval_context.task != eval_task or eval_context.final_evaluate != final_evaluate:
+            eval_context = EvalContext(args, eval_task, tokenizer, final_evaluate = final_evaluate, sort_by_length = args.eval_sort_by_length,
+                                   max_batch_tokens = args.max_batch_tokens)
+        eval_dataset = eval_context.dataset
+        eval_dataloader = eval_context.dataloader
+        dict_IndenToID = eval_context.dict_IndenToID
+        label_dict = eval_context.label_dict
 
         if not os.path.exists(eval_output_dir) and args.local_rank in [-1, 0]:
             os.makedirs(eval_output_dir)
 
-        args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-        # Note that DistributedSampler samples randomly
-        eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
-
         # multi-gpu eval
         if args.n_gpu > 1:
             model = torch.nn.DataParallel(model)
@@ -236,15 +634,44 @@ def evaluate(best_mif1, best_maf1, best_check, check,  args, model, tokenizer,
         logger.info("  Batch size = %d", args.eval_batch_size)
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
-        events = None
-        doc_ids = None
-        sent_ids = None
+        collector = EvalCollector(eval_context.num_examples)
         for batch in tqdm(eval_dataloader, desc="Evaluating"):
             model.eval()
 
-            batch = tuple(t.to(args.device) for t in batch)
+            if args.model_type in WINDOW_MODEL_TYPES:
+                batch = {name: t.to(args.device) for name, t in batch.items()}
+                with torch.no_grad():
+                    inputs = window_inputs(batch, args, evaluate=True)
+                    tmp_eval_loss, logits = model(**inputs)[:2]
+                    if not args.tbd:
+                        eval_loss += tmp_eval_loss.mean().detach()
+                nb_eval_steps += 1
+                collector.add(preds = softmax(logits).detach(),
+                              out_label_ids = batch['labels'],
+                              events = batch['event_ids'],
+                              doc_ids = batch['doc_ids'],
+                              sent_ids = batch['sen_ids'])
+                continue
+
+            if args.pack_pairs:
+                batch = {name: t.to(args.device) for name, t in batch.items()}
+                with torch.no_grad():
+                    tmp_eval_loss, logits = model(**packed_inputs(batch, args, evaluate=True))[:2]
+                    if not args.tbd:
+                        eval_loss += tmp_eval_loss.mean().detach()
+                nb_eval_steps += 1
+                collector.add(preds = softmax(logits).detach(),
+                              out_label_ids = batch['labels'],
+                              events = batch['event_ids'],
+                              doc_ids = batch['doc_ids'],
+                              sent_ids = batch['sen_ids'])
+                continue
+
+            batch = tuple(t.to(args.device).long() for t in batch)
+            if eval_context.order is not None and args.model_type not in ['xlnet']:
+                # rows are sorted by length and padded on the right, so the batch can be cut to its longest row
+                max_len = int(batch[1].sum(dim=1).max())
+                batch = tuple(t[:, :max_len] if i < 3 else t for i, t in enumerate(batch))
 
             with torch.no_grad():
                 inputs = {'input_ids':      batch[0],
@@ -252,6 +679,7 @@ def evaluate(best_mif1, best_maf1, best_check, check,  args, model, tokenizer,
                             'labels':         batch[4],
                             'evaluate': True,
                             'psllda':         args.psllda,
+                            'unpad':          args.unpadded_encoder,
                             }
 
                 event_ids = batch[3]
@@ -265,34 +693,24 @@ def evaluate(best_mif1, best_maf1, best_check, check,  args, model, tokenizer,
                 if args.tbd:
                     eval_loss = 0
                 else:
-                    eval_loss += tmp_eval_loss.mean().item()
+                    eval_loss += tmp_eval_loss.mean().detach()
 
             nb_eval_steps += 1 
 
-            if preds is None:
-                preds = softmax(logits).detach().cpu().numpy()
-                out_label_ids = inputs['labels'].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, softmax(logits).detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs['labels'].detach().cpu().numpy(), axis=0)
-
-            if events is None:
-                events = event_ids.detach().cpu().numpy()
-            else:
-                events = np.append(events, event_ids.detach().cpu().numpy(), axis=0)
+            collector.add(preds = softmax(logits).detach(),
+                          out_label_ids = inputs['labels'].detach(),
+                          events = event_ids,
+                          doc_ids = document_ids,
+                          sent_ids = sentence_ids)
 
-            if doc_ids is None:
-                doc_ids = document_ids.detach().cpu().numpy()
-            else:
-                doc_ids = np.append(doc_ids, document_ids.detach().cpu().numpy(), axis=0)
 
-            if sent_ids is None:
-                sent_ids = sentence_ids.detach().cpu().numpy()
-            else:
-                sent_ids = np.append(sent_ids, sentence_ids.detach().cpu().numpy(), axis=0)
-
-
-        eval_loss = eval_loss / nb_eval_steps
+        eval_loss = float(eval_loss) / nb_eval_steps
+        collected = {name: eval_context.restore_order(array) for name, array in collector.finalize().items()}
+        preds = collected['preds']
+        out_label_ids = collected['out_label_ids']
+        events = collected['events']
+        doc_ids = collected['doc_ids']
+        sent_ids = collected['sent_ids']
         if args.output_mode == "classification":
             labels = np.argmax(preds, axis=1)
             if not args.tbd:
@@ -385,80 +803,108 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False, final_evaluat
     processor = processors[task]()
     output_mode = output_modes[task]
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(args.data_dir, 'cached_{}_{}_{}_{}_{}'.format(
-        'test' if final_evaluate else 'dev' if evaluate else 'train',
+    # the cache is keyed on content, so dev/test features are shared across aug_round and repeated evaluations
+    split = 'test' if final_evaluate else 'dev' if evaluate else 'train'
+    settings = {'task': task,
+                'max_seq_length': args.max_seq_length,
+                'model_type': args.model_type,
+                'do_lower_case': args.do_lower_case,
+                'tbd': args.tbd,
+                'acrobat': args.acrobat,
+                'entity_marker_tokens': args.entity_marker_tokens,
+                'truncation': args.truncation,
+                'dedup_pairs': args.dedup_pairs,
+                }
+    if not evaluate:
+        # augmentation is only applied to the training set
+        settings['data_aug'] = args.data_aug
+        settings['aug_round'] = args.aug_round
+    cache_key = feature_cache_key(os.path.join(args.data_dir, split + '.json'), tokenizer, settings)
+    cached_features_file = os.path.join(args.data_dir, 'cached_{}_{}_{}'.format(
+        split,
         list(filter(None, args.model_name_or_path.split('/'))).pop(),
-        str(args.max_seq_length),
-        str(task),
-        str(args.aug_round)))
-    if os.path.exists(cached_features_file) and not args.overwrite_cache and not evaluate: 
+        cache_key[:16]))
+    label_list = processor.get_labels(args.tbd)
+    if not args.tbd:
+        label_dict = {x:y for x,y in enumerate(label_list)}
+    else:
+        label_dict = {0: 'overlap', 1: 'before', 2: 'after', 3:'vague', 4:'includs', 5:'is_included'}
+    if os.path.isdir(cached_features_file) and not args.overwrite_cache: 
         # load cache if exists
         logger.info("Loading features from cached file %s", cached_features_file)
-        features,dict_IndenToID = torch.load(cached_features_file)
-        label_list = processor.get_labels(args.tbd)
-        label_dict = {x:y for x,y in enumerate(label_list)}
+        columns, dict_IndenToID = load_feature_cache(cached_features_file)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
-        label_list = processor.get_labels(args.tbd)
-        if not args.tbd:
-            label_dict = {x:y for x,y in enumerate(label_list)}
-        else:
-            label_dict = {0: 'overlap', 1: 'before', 2: 'after', 3:'vague', 4:'includs', 5:'is_included'}
         if task in ['mnli', 'mnli-mm'] and args.model_type in ['roberta']:
             label_list[1], label_list[2] = label_list[2], label_list[1] 
         # final_evaluate indicate test data; only evaluate indicate dev data
         examples = processor.get_test_examples(args.data_dir, args.tbd) if final_evaluate else processor.get_dev_examples(args.data_dir, args.tbd) if evaluate else processor.get_train_examples(args.data_dir, args.tbd)
 
-        features, dict_IndenToID = convert_examples_to_features(examples,
-                                                tokenizer,
-                                                label_list=label_list,
-                                                max_length=args.max_seq_length,
-                                                output_mode=output_mode,
-                                                pad_on_left=bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
-                                                pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-                                                pad_token_segment_id=4 if args.model_type in ['xlnet'] else 0,
-                                                data_aug = args.data_aug,
-                                                evaluate = evaluate,
-                                                aug_round = args.aug_round,
-                                                tbd = args.tbd,
-                                                acrobat = args.acrobat,
-        )
+        if not evaluate and (args.data_aug == 'triple_rules' or args.model_type in WINDOW_MODEL_TYPES):
+            # the closure records the round every edge is derived in, so every aug_round reuses one closure
+            closure_key = feature_cache_key(os.path.join(args.data_dir, split + '.json'), None, {'task': task, 'tbd': args.tbd})
+            cached_closure_file = os.path.join(args.data_dir, 'cached_closure_{}_{}.npz'.format(split, closure_key[:16]))
+            if os.path.isfile(cached_closure_file) and not args.overwrite_cache:
+                logger.info("Loading closures from cached file %s", cached_closure_file)
+                closures = load_closure_cache(cached_closure_file)
+            else:
+                closures = [window_closure(example, args.tbd) for example in examples]
+                if args.local_rank in [-1, 0]:
+                    logger.info("Saving closures into cached file %s", cached_closure_file)
+                    save_closure_cache(cached_closure_file, closures)
+            for example, closure in zip(examples, closures):
+                example.closure = closure
+
+        if args.model_type in WINDOW_MODEL_TYPES:
+            features, dict_IndenToID = window_convert_examples_to_features(examples,
+                                                    tokenizer,
+                                                    max_length=args.max_seq_length,
+                                                    pad_on_left=bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
+                                                    pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                                                    pad_token_segment_id=4 if args.model_type in ['xlnet'] else 0,
+                                                    evaluate = evaluate,
+                                                    aug_round = args.aug_round,
+                                                    tbd = args.tbd,
+                                                    num_workers = args.preprocessing_num_workers,
+            )
+            columns = window_features_to_columns(features, tbd = args.tbd)
+        else:
+            features, dict_IndenToID = convert_examples_to_features(examples,
+                                                    tokenizer,
+                                                    label_list=label_list,
+                                                    max_length=args.max_seq_length,
+                                                    output_mode=output_mode,
+                                                    pad_on_left=bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
+                                                    pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                                                    pad_token_segment_id=4 if args.model_type in ['xlnet'] else 0,
+                                                    data_aug = args.data_aug,
+                                                    evaluate = evaluate,
+                                                    aug_round = args.aug_round,
+                                                    tbd = args.tbd,
+                                                    acrobat = args.acrobat,
+                                                    truncation = args.truncation,
+                                                    dedup_pairs = args.dedup_pairs,
+                                                    num_workers = args.preprocessing_num_workers,
+            )
+            columns = features_to_columns(features, tbd = args.tbd, evaluate = evaluate)
+        del features
         if args.local_rank in [-1, 0]:
             logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save((features,dict_IndenToID), cached_features_file)
+            save_feature_cache(cached_features_file, columns, dict_IndenToID)
+            # reopen memory-mapped so the training set is not kept resident twice
+            columns, dict_IndenToID = load_feature_cache(cached_features_file)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_mask = torch.tensor([f.attention_masks for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
-    all_event_ids = torch.tensor([f.ids for f in features], dtype=torch.long)
-    #all_node_pos = torch.tensor([f.node_pos for f in features], dtype=torch.long)
-    if output_mode == "classification":
-        all_labels = torch.tensor([f.relations for f in features], dtype=torch.long)
-    elif output_mode == "regression":
-        all_labels = torch.tensor([f.relations for f in features], dtype=torch.float)
-    all_doc_ids = torch.tensor([f.doc_id for f in features], dtype = torch.int)
-    all_sources = [f.sources for f in features] 
+    if args.model_type in WINDOW_MODEL_TYPES:
+        return WindowDataset(columns), dict_IndenToID, label_dict
     if not evaluate:
-        all_rules = torch.tensor([f.rules for f in features], dtype = torch.int)
-        if not args.tbd:
-            all_sen_ids = torch.tensor([[[int(i) for i in s[1:len(s)-1].replace(':',', ').split(", ")] for s in f.sen_id] for f in features])
-        else:
-            all_sen_ids = torch.tensor([[[int(i) for i in s[1:len(s)-1].split(":")] for s in f.sen_id] for f in features])    
-
+        # the training triples index a table of distinct pairs and are gathered batch by batch
+        return TripleDataset(columns), dict_IndenToID, label_dict
 
-        data_type = None
-
-        dataset = TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_event_ids, all_labels, all_doc_ids, all_sen_ids,  all_rules)#,all_node_pos , all_event_ids)
-    else:
-        if not args.tbd:
-            all_sen_ids = torch.tensor([[int(i) for i in f.sen_id[1:len(f.sen_id)-1].replace(':',', ').split(", ")] for f in features])
-        else:
-            all_sen_ids = torch.tensor([[int(i) for i in f.sen_id[1:len(f.sen_id)-1].split(":")] for f in features])    
-        dataset = TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_event_ids, all_labels, all_doc_ids, all_sen_ids)#,all_node_pos , all_event_ids)
+    # The columns are stored as int16/int32 and shared with the memory map; batches are cast to long on the device
+    dataset = TensorDataset(*[torch.from_numpy(columns[name]) for name in pair_columns(evaluate)])
     return dataset, dict_IndenToID, label_dict
 
 
@@ -518,6 +964,14 @@ def main():
                         help="Set this flag if you are using a TBDense data.")
     parser.add_argument("--acrobat", action='store_true',
                         help="Set this flag if you are using a ACROBAT data.")
+    parser.add_argument("--entity_marker_tokens", action='store_true',
+                        help="Add the entity markers <e1>, </e1>, <e2>, </e2> to the vocabulary as special tokens so each takes one token.")
+    parser.add_argument("--truncation", default='right', choices=['right', 'entity'],
+                        help="How pairs longer than max_seq_length are cut: 'right' keeps the beginning, "
+                             "'entity' keeps both marked entities, the text between them and balanced context around them.")
+    parser.add_argument("--dedup_pairs", action='store_true',
+                        help="i2b2 pair models: evaluate a gold pair found in several overlapping windows once, in the window "
+                             "where its events are most central, and train on it there only as a rule-less edge.")
 
     parser.add_argument("--per_gpu_train_batch_size", default=8, type=int,
                         help="Batch size per GPU/CPU for training.")
@@ -547,7 +1001,7 @@ def main():
     parser.add_argument('--save_steps', type=int, default=500,
                         help="Save checkpoint every X updates steps.")
     parser.add_argument('--aug_round', type=int, default=0,
-                        help="augment data for X round")
+                        help="augment data for X round; a negative value applies the exact closure")
     parser.add_argument("--eval_all_checkpoints", action='store_true',
                         help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number")
     parser.add_argument("--no_cuda", action='store_true',
@@ -556,8 +1010,22 @@ def main():
                         help="node embedding")
     parser.add_argument('--overwrite_output_dir', action='store_true',
                         help="Overwrite the content of the output directory")
+    parser.add_argument("--eval_sort_by_length", action='store_true',
+                        help="Sort the evaluation set by sequence length once and cut each batch to its longest sequence.")
+    parser.add_argument("--max_batch_tokens", default=0, type=int,
+                        help="When > 0, group training and evaluation items of similar length into batches of at most this many "
+                             "tokens (rows x longest row, a training triple counts its three rows) padded to their longest row. "
+                             "Replaces the per-GPU batch sizes; single process only.")
+    parser.add_argument("--unpadded_encoder", action='store_true',
+                        help="Run the encoder of the pair model on the real tokens of a batch only, so its cost follows the number of "
+                             "real tokens rather than batch size x max_seq_length.")
+    parser.add_argument("--pack_pairs", action='store_true',
+                        help="Pack several pair inputs of a batch into each max_seq_length row, each attending to its own tokens "
+                             "with restarted position ids and classified from its own [CLS].")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--preprocessing_num_workers', type=int, default=0,
+                        help="Number of processes used to convert examples to features, sharded by document")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
 
@@ -572,6 +1040,17 @@ def main():
     # parser.add_argument('--server_port', type=str, default='', help="For distant debugging.")
     args = parser.parse_args()
 
+    if args.pack_pairs and (args.unpadded_encoder or args.model_type in WINDOW_MODEL_TYPES):
+        raise ValueError("--pack_pairs packs the inputs of the pair model and cannot be combined with --unpadded_encoder or a window model")
+    if args.model_type in WINDOW_MODEL_TYPES:
+        # the window model encodes each window once, without entity markers, cut from the right
+        pair_options = [name for name, value in [('--dedup_pairs', args.dedup_pairs), ('--acrobat', args.acrobat),
+                                                 ('--truncation entity', args.truncation != 'right'),
+                                                 ('--unpadded_encoder', args.unpadded_encoder),
+                                                 ('--entity_marker_tokens', args.entity_marker_tokens)] if value]
+        if pair_options:
+            raise ValueError("{} only apply to the pair model and cannot be combined with a window model".format(', '.join(pair_options)))
+
     if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and args.do_train and not args.overwrite_output_dir:
         raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
 
@@ -623,6 +1102,8 @@ def main():
                                         from_tf=bool('.ckpt' in args.model_name_or_path),
                                         config=config,
                                         cache_dir=args.cache_dir if args.cache_dir else None)
+    if args.entity_marker_tokens:
+        add_entity_markers(tokenizer, model)
 
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
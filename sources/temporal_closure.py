@@ -0,0 +1,385 @@
+'''
+Transitive closure of the BEFORE / OVERLAP relations of a context window.
+
+The rules applied by iter_rule_update are
+    if Bij Ojk, then Bik
+    if Oij Bjk, then Bik
+    if Bij Bjk, then Bik
+    if Oij Ojk, then Oik
+    if Oij, then Oji
+so OVERLAP is an equivalence relation and BEFORE is a partial order between its classes.
+The exact closure merges the OVERLAP-connected events with union-find, propagates BEFORE
+reachability over the condensed DAG in reverse topological order with integer bitsets, and
+expands the classes back to event matrices.
+A closure capped at aug_round rounds keeps the edges whose shortest derivation has at most 2**aug_round
+edges. Those lengths depend on the OVERLAP distances inside a class, so they cannot be read off the
+condensed DAG; they come from one breadth-first search over the events instead (derivation_rounds).
+
+The TB-Dense relations (tbd_closure) do not reduce to a partial order, so they are closed by path
+consistency: every pair holds the set of labels it may still take as a bitmask, the sets are narrowed by
+the composition table of the six labels, and only the edges that changed are revisited.
+'''
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from relation_matrix import RelationMatrix
+
+
+class UnionFind(object):
+    '''
+    disjoint sets over 0..n-1 with path halving and union by size
+    '''
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return x
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+        return x
+
+    def classes(self):
+        '''
+        class index of every element, numbered in order of first appearance
+        '''
+        roots = {}
+        return np.array([roots.setdefault(self.find(x), len(roots)) for x in range(len(self.parent))], dtype=np.int64)
+
+
+def overlap_classes(OM):
+    '''
+    class index of every event, two events share a class when an OVERLAP path connects them
+    '''
+    uf = UnionFind(OM.shape[0])
+    for x, y in zip(*np.nonzero(OM)):
+        uf.union(int(x), int(y))
+    return uf.classes()
+
+
+def before_overlap_closure(BM, OM):
+    '''
+    exact closure of BM / OM (OM is treated as symmetric)
+
+    Returns:
+        the closed BM and OM as 0/1 float matrices with an empty OM diagonal, and whether the relations
+        are consistent: False when a BEFORE edge joins two overlapping events or BEFORE has a cycle
+    '''
+    n = BM.shape[0]
+    cls = overlap_classes(OM)
+    n_class = int(cls.max()) + 1 if n else 0
+    src, dst = np.nonzero(BM)
+    src, dst = cls[src], cls[dst]
+    consistent = not np.any(src == dst)
+
+    # successors of every class and Kahn's topological order
+    succ = [set() for _ in range(n_class)]
+    for x, y in zip(src.tolist(), dst.tolist()):
+        if x != y:
+            succ[x].add(y)
+    indegree = [0] * n_class
+    for ys in succ:
+        for y in ys:
+            indegree[y] += 1
+    order = [c for c in range(n_class) if indegree[c] == 0]
+    for c in order:
+        for y in succ[c]:
+            indegree[y] -= 1
+            if indegree[y] == 0:
+                order.append(y)
+    if len(order) < n_class:
+        consistent = False
+        # classes on a cycle are appended so every class still gets a (partial) reachability set
+        seen = set(order)
+        order.extend(c for c in range(n_class) if c not in seen)
+
+    # reach[c] has bit d set when class d is after class c; exact only for the consistent case
+    reach = [0] * n_class
+    for c in reversed(order):
+        bits = 0
+        for y in succ[c]:
+            bits |= (1 << y) | reach[y]
+        reach[c] = bits
+
+    class_reach = RelationMatrix.from_bitsets(reach, n_class).to_bool()
+    closed_BM = class_reach[cls][:, cls].astype(np.float64)
+    closed_OM = (cls[:, None] == cls[None, :]).astype(np.float64)
+    np.fill_diagonal(closed_OM, 0)
+    return closed_BM, closed_OM, consistent
+
+
+def walk_depths(A):
+    '''
+    length of the shortest walk of at least one edge between every two nodes of the RelationMatrix A, -1 when
+    there is none; a breadth-first search from all the nodes at once, every pair is in one frontier only
+    '''
+    depth = np.full((A.n, A.n), -1, dtype=np.int64)
+    reached = frontier = A
+    d = 1
+    while frontier.any():
+        depth[frontier.nonzero()] = d
+        frontier = (frontier @ A) & ~reached
+        reached = reached | frontier
+        d += 1
+    return depth
+
+
+def derivation_rounds(BM, OM, max_round = -1):
+    '''
+    the round of iter_rule_update in which every BEFORE and OVERLAP edge is first derived, -1 when it is
+    not derived within max_round rounds (ever, when max_round < 0). Round t squares the relations, so it
+    holds the walks of at most 2**t edges: a BEFORE edge of round t has a walk over BEFORE and OVERLAP
+    edges with at least one BEFORE edge of at most 2**t edges, an OVERLAP edge one over OVERLAP edges.
+    The shortest walks are the depths of a breadth-first search; the one with a BEFORE edge runs on two
+    copies of the events, before and after the first BEFORE edge of the walk.
+    '''
+    n = BM.shape[0]
+    O = RelationMatrix.from_dense(OM)
+    O = O | O.T
+    B_src, B_dst = np.nonzero(BM > 0)
+    O_src, O_dst = O.nonzero()
+    # events 0..n-1 before the first BEFORE edge, n..2n-1 after it
+    layered = RelationMatrix.from_pairs(2 * n, np.concatenate([O_src, B_src, O_src + n, B_src + n]),
+                                        np.concatenate([O_dst, B_dst + n, O_dst + n, B_dst + n]))
+    rounds = []
+    for depth in [walk_depths(layered)[:n, n:], walk_depths(O)]:
+        depth_round = np.where(depth > 0, np.ceil(np.log2(np.maximum(depth, 1))), -1).astype(np.int8)
+        if max_round >= 0:
+            depth_round[depth_round > max_round] = -1
+        rounds.append(depth_round)
+    return tuple(rounds)
+
+
+def closure_depth(n):
+    '''
+    number of rounds after which the closure of n events is exact: a shortest derivation uses at most n edges
+    '''
+    return int(np.ceil(np.log2(max(n, 2))))
+
+
+def capped_closure(BM, OM, max_round = -1):
+    '''
+    closure of BM / OM after at most max_round rounds: the union-find / DAG closure when max_round < 0 or is
+    deep enough, otherwise the edges derivation_rounds derives within max_round rounds
+
+    Returns:
+        closed BM, closed OM and whether the derived relations are consistent
+    '''
+    n = BM.shape[0]
+    if max_round < 0 or max_round >= closure_depth(n):
+        return before_overlap_closure(BM, OM)
+    B_round, O_round = derivation_rounds(BM, OM, max_round)
+    closed_BM = (B_round >= 0).astype(np.float64)
+    closed_OM = (O_round >= 0).astype(np.float64)
+    np.fill_diagonal(closed_OM, 0)
+    # a self loop or BEFORE in both directions
+    B = RelationMatrix.from_dense(closed_BM)
+    consistent = not (B.diagonal().any() or (B & B.T).any())
+    return closed_BM, closed_OM, consistent
+
+
+def closure_rounds(BM, OM):
+    '''
+    the closure run to the fixpoint once, kept with the round of every derived edge so that
+    capped_closure(BM, OM, max_round) can be read back for any max_round with closure_at_round; the rounds
+    are the depths of derivation_rounds, which reach the same edges as before_overlap_closure
+
+    Returns:
+        dict of the B_round and O_round of derivation_rounds and the first round whose closure has a self
+        loop or BEFORE in both directions (-1 when there is none)
+    '''
+    B_round, O_round = derivation_rounds(BM, OM)
+    both = (B_round >= 0) & (B_round.T >= 0)
+    contradictions = np.maximum(B_round, B_round.T)[both]
+    failed_round = int(contradictions.min()) if contradictions.size else -1
+    return {'B_round': B_round, 'O_round': O_round, 'failed_round': failed_round}
+
+
+def closure_at_round(closure, max_round = -1):
+    '''
+    the same as capped_closure(BM, OM, max_round) from the closure_rounds of the window
+    '''
+    B_round, O_round = closure['B_round'], closure['O_round']
+    if max_round < 0 or max_round >= closure_depth(B_round.shape[0]):
+        max_round = np.iinfo(B_round.dtype).max
+    closed_BM = ((B_round >= 0) & (B_round <= max_round)).astype(np.float64)
+    closed_OM = ((O_round >= 0) & (O_round <= max_round)).astype(np.float64)
+    np.fill_diagonal(closed_OM, 0)
+    failed_round = closure['failed_round']
+    consistent = failed_round < 0 or max_round < failed_round
+    return closed_BM, closed_OM, consistent
+
+
+# TB-Dense labels, indexed by their label id: 0 SIMULTANEOUS, 1 BEFORE, 2 AFTER, 3 VAGUE, 4 INCLUDES, 5 IS_INCLUDED
+TBD_LABELS = ['SIMULTANEOUS', 'BEFORE', 'AFTER', 'VAGUE', 'INCLUDES', 'IS_INCLUDED']
+TBD_INVERSE = [0, 2, 1, 3, 5, 4]
+# a relation is stored as the set of labels it may still take, one bit per definite label; VAGUE carries
+# no information and is the set of all of them
+TBD_BITS = [1 << label if label != 3 else 0 for label in range(6)]
+TBD_ALL = sum(TBD_BITS)
+TBD_BITS[3] = TBD_ALL
+
+S, B, A, V, I, II = range(6)
+# TBD_COMPOSITION[r1][r2] is the label of x-z when x-y is r1 and y-z is r2; VAGUE when it is not determined
+TBD_COMPOSITION = [
+    #   S   B   A   V   I   II
+    [   S,  B,  A,  V,  I,  II],    # S
+    [   B,  B,  V,  V,  B,  V],     # B
+    [   A,  V,  A,  V,  A,  V],     # A
+    [   V,  V,  V,  V,  V,  V],     # V
+    [   I,  V,  V,  V,  I,  V],     # I
+    [   II, B,  A,  V,  V,  II],    # II
+]
+del S, B, A, V, I, II
+
+
+def _label_set_tables():
+    '''
+    composition and inverse of every label set, and the label of the sets holding a single label (-1 otherwise)
+    '''
+    n_set = TBD_ALL + 1
+    members = [[label for label in range(6) if label != 3 and s & TBD_BITS[label]] for s in range(n_set)]
+    compose = np.zeros((n_set, n_set), dtype=np.uint8)
+    for s1 in range(n_set):
+        for s2 in range(n_set):
+            bits = 0
+            for r1 in members[s1]:
+                for r2 in members[s2]:
+                    bits |= TBD_BITS[TBD_COMPOSITION[r1][r2]]
+            compose[s1, s2] = bits
+    inverse = np.array([sum(TBD_BITS[TBD_INVERSE[label]] for label in members[s]) for s in range(n_set)], dtype=np.uint8)
+    single = np.array([members[s][0] if len(members[s]) == 1 else -1 for s in range(n_set)], dtype=np.int64)
+    return compose, inverse, single
+
+SET_COMPOSITION, SET_INVERSE, SET_LABEL = _label_set_tables()
+
+
+def path_consistency(M, max_round = -1):
+    '''
+    path consistency of an n*n array of label sets: Mik is narrowed to the composition of Mij and Mjk for
+    every j until nothing changes. Only the triangles of an edge that changed are revisited: round t reads
+    the relations as they were after round t-1 and the edges it changes are revisited in round t+1, so
+    round t holds the derivations over paths of at most 2**t edges as in iter_rule_update. No more than
+    max_round rounds run when max_round >= 0.
+
+    Returns:
+        the narrowed M, the round in which every edge got its single label (0 when it had it, -1 otherwise)
+        and the round in which a relation was left without any label, -1 when M is consistent
+    '''
+    M = M.copy()
+    n = M.shape[0]
+    rounds = np.where(SET_LABEL[M] >= 0, 0, -1).astype(np.int8)
+    if not M.all():
+        return M, rounds, 0
+    queued = np.zeros((n, n), dtype=bool)
+    queue = []
+    for x, y in zip(*np.nonzero(np.triu(M != TBD_ALL, 1))):
+        queue.append((int(x), int(y)))
+        queued[x, y] = True
+
+    t = 0
+    while queue and (max_round < 0 or t < max_round):
+        t += 1
+        last = M.copy()
+        next_queue = []
+        for x, y in queue:
+            queued[x, y] = False
+            r = last[x, y]
+            # x-k through x-y-k, and k-y through k-x-y
+            for row, col, new in [(x, None, M[x] & SET_COMPOSITION[r, last[y]]),
+                                  (None, y, M[:, y] & SET_COMPOSITION[last[:, x], r])]:
+                old = M[x] if col is None else M[:, y]
+                ks = np.nonzero(new != old)[0]
+                if ks.size == 0:
+                    continue
+                if not np.all(new[ks]):
+                    return M, rounds, t
+                src = np.full(ks.size, row) if col is None else ks
+                dst = ks if col is None else np.full(ks.size, col)
+                M[src, dst] = new[ks]
+                M[dst, src] = SET_INVERSE[new[ks]]
+                fixed = (SET_LABEL[new[ks]] >= 0) & (rounds[src, dst] < 0)
+                rounds[src[fixed], dst[fixed]] = t
+                rounds[dst[fixed], src[fixed]] = t
+                for a, b in zip(np.minimum(src, dst).tolist(), np.maximum(src, dst).tolist()):
+                    if not queued[a, b]:
+                        queued[a, b] = True
+                        next_queue.append((a, b))
+        queue = next_queue
+    return M, rounds, -1
+
+
+def tbd_label_sets(BM, OM, IM, VM):
+    '''
+    n*n label sets of the TB-Dense relations of a window; BM holds BEFORE (AFTER transposed), IM INCLUDES
+    (IS_INCLUDED transposed), OM SIMULTANEOUS and VM VAGUE. Pairs without a relation take every label.
+    '''
+    n = BM.shape[0]
+    M = np.full((n, n), TBD_ALL, dtype=np.uint8)
+    for mat, label in [(BM, 1), (OM, 0), (IM, 4), (VM, 3)]:
+        mask = mat > 0
+        M[mask] &= TBD_BITS[label]
+        M[mask.T] &= TBD_BITS[TBD_INVERSE[label]]
+    np.fill_diagonal(M, TBD_BITS[0])
+    return M
+
+
+def tbd_closure(BM, OM, IM, VM, max_round = -1):
+    '''
+    TB-Dense closure of a window by path consistency, see path_consistency for max_round.
+    The VAGUE pairs keep their annotation and only take part as unconstrained relations.
+
+    Returns:
+        closed BM, OM, IM as 0/1 float matrices (OM symmetric with an empty diagonal), and whether the
+        relations are consistent
+    '''
+    M, _, failed_round = path_consistency(tbd_label_sets(BM, OM, IM, VM), max_round)
+    return _tbd_matrices(SET_LABEL[M], VM) + (failed_round < 0,)
+
+
+def _tbd_matrices(labels, VM):
+    '''
+    BM, OM, IM of an n*n array of label ids (-1 for none), leaving out the VAGUE pairs and the diagonal
+    '''
+    labels = labels.copy()
+    labels[(VM > 0) | (VM > 0).T] = -1
+    np.fill_diagonal(labels, -1)
+    return (labels == 1).astype(np.float64), (labels == 0).astype(np.float64), (labels == 4).astype(np.float64)
+
+
+def tbd_closure_rounds(BM, OM, IM, VM):
+    '''
+    the TB-Dense closure run to the fixpoint once, kept with the round of every derived edge so that the
+    closure after any number of rounds can be read back with tbd_closure_at_round
+
+    Returns:
+        dict of the label id of every pair (-1 for none), the round it got the label and the round in
+        which the relations turned out contradictory (-1 when they are consistent)
+    '''
+    M, rounds, failed_round = path_consistency(tbd_label_sets(BM, OM, IM, VM))
+    labels = np.where(rounds >= 0, SET_LABEL[M], -1).astype(np.int8)
+    return {'labels': labels, 'rounds': rounds, 'failed_round': failed_round}
+
+
+def tbd_closure_at_round(closure, VM, max_round = -1):
+    '''
+    the same as tbd_closure(BM, OM, IM, VM, max_round) from the tbd_closure_rounds of the window
+    '''
+    rounds = closure['rounds']
+    kept = (rounds >= 0) if max_round < 0 else (rounds >= 0) & (rounds <= max_round)
+    labels = np.where(kept, closure['labels'], -1)
+    failed_round = closure['failed_round']
+    consistent = failed_round < 0 or 0 <= max_round < failed_round
+    return _tbd_matrices(labels, VM) + (consistent,)
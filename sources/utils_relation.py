@@ -9,6 +9,13 @@ import copy
 import json
 import numpy as np
 import random
+import multiprocessing
+import shutil
+import hashlib
+import collections
+
+from relation_matrix import RelationMatrix
+from temporal_closure import TBD_LABELS, capped_closure, closure_rounds, closure_at_round, tbd_closure, tbd_closure_rounds, tbd_closure_at_round
 
 logger = logging.getLogger(__name__)
 
@@ -215,6 +222,44 @@ class Input_SB_Features(object):
         return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
 
 
+class Input_Window_Features(object):
+    """
+    The features of one context window for the shared-encoder model, which encodes the window
+    once and classifies all of its pairs.
+
+    Args:
+        input_ids: Indices of the window tokens in the vocabulary, without entity markers.
+        attention_masks: Mask to avoid performing attention on padding token indices.
+        token_type_ids: Segment token indices.
+        entity_spans: (start, end) token span of each event index of the window, end exclusive,
+            ``(-1, -1)`` when the event is truncated.
+        pairs: (e1, e2, label) of every labelled pair of the window.
+        triples: (A-B, B-C, A-C) indices into ``pairs`` and the rule the three labels follow.
+    """
+
+    def __init__(self, input_ids, attention_masks, token_type_ids, entity_spans, pairs, triples, doc_id, sen_id):
+        self.input_ids = input_ids
+        self.attention_masks = attention_masks
+        self.token_type_ids = token_type_ids
+        self.entity_spans = entity_spans
+        self.pairs = pairs
+        self.triples = triples
+        self.doc_id = doc_id
+        self.sen_id = sen_id
+
+    def __repr__(self):
+        return str(self.to_json_string())
+
+    def to_dict(self):
+        """Serializes this instance to a Python dictionary."""
+        output = copy.deepcopy(self.__dict__)
+        return output
+
+    def to_json_string(self):
+        """Serializes this instance to a JSON string."""
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
+
+
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
@@ -431,6 +476,9 @@ def sb_convert_examples_to_features(examples, tokenizer,
                                       aug_round = 0,
                                       tbd = False,
                                       acrobat = False,
+                                      num_workers = 0,
+                                      truncation = 'right',
+                                      dedup_pairs = False,
                                       ):#max_node_size=650
     """
     Loads a data file into a list of ``InputFeatures``
@@ -448,11 +496,19 @@ def sb_convert_examples_to_features(examples, tokenizer,
         mask_padding_with_zero: If set to ``True``, the attention mask will be filled by ``1`` for actual values
             and by ``0`` for padded values. If set to ``False``, inverts it (``1`` for padded values, ``0`` for
             actual values)
+        num_workers: If larger than 1, the examples are sharded by document across a pool of ``num_workers``
+            processes; the merged features and ``dict_IndenToID`` are identical to the serial ones
+        truncation: ``right`` cuts long inputs from the right, ``entity`` keeps the marked entities and the
+            tokens between them with balanced context (see ``PairEncoder``)
+        dedup_pairs: i2b2 only, keep a gold pair found in several overlapping windows in one canonical window
+            (see ``duplicate_window_pairs``); the other windows skip it for evaluation and as a rule-less
+            training edge, their rule triangles are kept whole
 
     Returns:
         If the ``examples`` input is a ``tf.data.Dataset``, will return a ``tf.data.Dataset``
         containing the task-specific features. If the input is a list of ``InputExamples``, will return
-        a list of task-specific ``InputFeatures`` which can be fed to the model.
+        a list of task-specific ``InputFeatures`` which can be fed to the model; with ``triple_rules``
+        the triples of every window come as one block of columns (``TripleAssembler.arrays``).
 
     """
     is_tf_dataset = False
@@ -469,26 +525,97 @@ def sb_convert_examples_to_features(examples, tokenizer,
 
     label_map = {label.lower(): i for i, label in enumerate(label_list)}    
 
+    # data_aug is how the data is augmented
+    # only use data_aug = triple_rules or evaluate for now
+    if evaluate: 
+        data_aug = 'evaluate'
+
+    convert_args = dict(max_length=max_length,
+                        pad_on_left=pad_on_left,
+                        pad_token=pad_token,
+                        pad_token_segment_id=pad_token_segment_id,
+                        mask_padding_with_zero=mask_padding_with_zero,
+                        data_aug=data_aug,
+                        aug_round=aug_round,
+                        tbd=tbd,
+                        acrobat=acrobat,
+                        truncation=truncation)
+
+    if is_tf_dataset:
+        examples = [processor.tfds_map(processor.get_example_from_tensor_dict(example)) for example in examples]
+
+    if dedup_pairs and not tbd:
+        # the pairs travel with the examples, so the workers see them too
+        for example, pairs in zip(examples, duplicate_window_pairs(examples)):
+            example.duplicate_pairs = pairs
+
+    if num_workers > 1:
+        results = parallel_convert_examples(examples, tokenizer, num_workers, convert_args)
+    else:
+        results = [sb_convert_chunk(examples, tokenizer, **convert_args)]
+
+    # merge in example order
+    features = []
+    dict_IndenToID = {}
+    remove_count = 0
+    sum_BBB = 0
+    sum_BOB = 0
+    sum_OBB = 0
+    sum_OOO = 0
+    for chunk_features, chunk_dict, chunk_remove, (chunk_BBB, chunk_BOB, chunk_OBB, chunk_OOO) in results:
+        features.extend(chunk_features)
+        dict_IndenToID.update(chunk_dict)
+        remove_count += chunk_remove
+        sum_BBB += chunk_BBB
+        sum_BOB += chunk_BOB
+        sum_OBB += chunk_OBB
+        sum_OOO += chunk_OOO
+
+    print("remove number", remove_count)
+    print("sucessfully loading data!!!!!!!!!!!!!!!!!!!")
+    print("sum of rule BBB",sum_BBB)
+    print("sum of rule BOB",sum_BOB)
+    print("sum of rule OBB",sum_OBB)
+    print("sum of rule OOO",sum_OOO)
+    #exit()
+    return features, dict_IndenToID
+
+
+def sb_convert_chunk(examples, tokenizer,
+                     max_length=64,
+                     pad_on_left=False,
+                     pad_token=0,
+                     pad_token_segment_id=0,
+                     mask_padding_with_zero=True,
+                     data_aug = 'reduce',
+                     aug_round = 0,
+                     tbd = False,
+                     acrobat = False,
+                     truncation = 'right',
+                     start_index = 0,
+                     ):
+    """
+    Converts a contiguous run of examples; see ``sb_convert_examples_to_features``.
+
+    Returns:
+        features (for triple_rules the column blocks of TripleAssembler, one per window), dict_IndenToID,
+        the number of windows whose rules were contradictory and the (BBB, BOB, OBB, OOO) rule counts
+    """
     features = []
 
     dict_IndenToID = {}
     
-    wrong_count = 0
-    sen_count = 0
     remove_count = 0
     sum_BBB = 0
     sum_BOB = 0
     sum_OBB = 0
     sum_OOO = 0
+    memo = PairEncodingMemo()
+    triple_rows = 0
 
-    for (ex_index, example) in enumerate(examples):
-        sen_count+=1
+    for (ex_index, example) in enumerate(examples, start_index):
         if ex_index % 10000 == 0:
             logger.info("Writing example %d" % (ex_index))
-        if is_tf_dataset:
-            example = processor.get_example_from_tensor_dict(example)
-            example = processor.tfds_map(example)
-
 
         input_ids, token_type_ids, attention_masks = [], [], []
         example.doc_id = str(example.doc_id)
@@ -501,16 +628,10 @@ def sb_convert_examples_to_features(examples, tokenizer,
         else:
             dict_IndenToID[str(example.doc_id)+example.sen_id] = IndexToID
 
-        # data_aug is how the data is augmented
-        # only use data_aug = triple_rules or evaluate for now
-        if evaluate: 
-            data_aug = 'evaluate'
-
-
         if data_aug == "triple_rules":
             if tbd:
                 BM, OM, IDM, pos_dict, VM, IM = build_BO(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
-                BM, OM, IM, VM, remove_count = iter_rule_update_tbd(BM, OM, IM, VM,aug_round, wrong_count, evaluate = False)
+                BM, OM, IM, VM, remove_count = iter_rule_update_tbd(BM, OM, IM, VM,aug_round, remove_count, evaluate = False, closure = getattr(example, 'closure', None))
                 OM = np.zeros(BM.shape)
                 AM = BM.transpose()
                 TIM = IM.transpose()
@@ -520,7 +641,7 @@ def sb_convert_examples_to_features(examples, tokenizer,
             else:
                 BM, OM, IDM, pos_dict, VM = build_BO(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
                 VM = np.zeros(VM.shape)
-                BM, OM, remove_count = iter_rule_update(BM, OM, aug_round, wrong_count, evaluate = False)
+                BM, OM, remove_count = iter_rule_update(BM, OM, aug_round, remove_count, evaluate = False, closure = getattr(example, 'closure', None))
                 AM = BM.transpose()
                 IDM = np.zeros(BM.shape)
                 IDM = IDM + BM + AM + OM + VM
@@ -534,12 +655,18 @@ def sb_convert_examples_to_features(examples, tokenizer,
                 for text in example.text:
                     texts.extend(text)
 
+            # tokenize the window once for all the pairs
+            encoder = PairEncoder(tokenizer, texts, pos_dict, max_length, mask_padding_with_zero, pad_token, pad_token_segment_id, pad_on_left, truncation=truncation)
+            doc_id = example.doc_id[len(example.doc_id)-4:len(example.doc_id)] if tbd else example.doc_id
+            assembler = TripleAssembler(doc_id, example.sen_id, tbd, memo = memo, skip = duplicate_pair_mask(example, IDToIndex))
+
             if acrobat:
-                sum_BBB, sum_BOB, sum_OBB, sum_OOO = add_features_triple_ACROBAT(sum_BBB, sum_BOB, sum_OBB, sum_OOO,features, BM, OM,  pos_dict,IDM,  tokenizer , texts, example.doc_id,example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id, pad_on_left)
-            if tbd:
-                sum_BBB, sum_BOB, sum_OBB, sum_OOO = add_features_triple(sum_BBB, sum_BOB, sum_OBB, sum_OOO,features, BM, OM,VM,IM,  pos_dict,IDM,  tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)],example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id, pad_on_left, tbd=True)
-            else:
-                sum_BBB, sum_BOB, sum_OBB, sum_OOO = add_features_triple(sum_BBB, sum_BOB, sum_OBB, sum_OOO,features, BM, OM,VM, None, pos_dict,IDM,  tokenizer , texts, example.doc_id,example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id, pad_on_left,tbd=False)
+                acrobat_encoder = PairEncoder(tokenizer, texts, pos_dict, max_length, mask_padding_with_zero, pad_token, pad_token_segment_id, pad_on_left, joiner='', truncation=truncation)
+                sum_BBB, sum_BOB, sum_OBB, sum_OOO = add_features_triple_ACROBAT(sum_BBB, sum_BOB, sum_OBB, sum_OOO, assembler, BM, OM, encoder, acrobat_encoder)
+            sum_BBB, sum_BOB, sum_OBB, sum_OOO = add_features_triple(sum_BBB, sum_BOB, sum_OBB, sum_OOO, assembler, BM, OM, VM, IM if tbd else None, encoder, tbd)
+            if len(assembler):
+                features.append(assembler.arrays())
+                triple_rows += 3 * len(assembler)
 
         elif data_aug == 'evaluate':
 
@@ -554,6 +681,9 @@ def sb_convert_examples_to_features(examples, tokenizer,
             else:
                 IDM = IDM + BM + AM + OM
             IDM[np.where(IDM>0)] = 1
+            skip = duplicate_pair_mask(example, IDToIndex)
+            if skip is not None:
+                IDM[skip] = 0
 
             # merge three sentences
             if tbd: 
@@ -563,33 +693,462 @@ def sb_convert_examples_to_features(examples, tokenizer,
                 for text in example.text:
                     texts.extend(text)
             
+            # tokenize the window once for all the pairs
+            encoder = PairEncoder(tokenizer, texts, pos_dict, max_length, mask_padding_with_zero, pad_token, pad_token_segment_id, pad_on_left, truncation=truncation)
+
             if not tbd:
-                add_features(features, BM, pos_dict,IDM, 'BM', tokenizer , texts, example.doc_id,example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id, pad_on_left)
+                add_features(features, BM, IDM, 'BM', encoder, example.doc_id, example.sen_id)
  
-                add_features(features, AM, pos_dict,IDM,'AM', tokenizer , texts, example.doc_id, example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
+                add_features(features, AM, IDM, 'AM', encoder, example.doc_id, example.sen_id)
 
-                add_features(features, OM, pos_dict,IDM, 'OM', tokenizer , texts, example.doc_id, example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
+                add_features(features, OM, IDM, 'OM', encoder, example.doc_id, example.sen_id)
             if tbd:
 
-                add_features(features, BM, pos_dict,IDM, 'BM', tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)],example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id, pad_on_left) 
-                add_features(features, AM, pos_dict,IDM,'AM', tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
+                add_features(features, BM, IDM, 'BM', encoder, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id) 
+                add_features(features, AM, IDM, 'AM', encoder, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id)
 
-                add_features(features, OM, pos_dict,IDM, 'OM', tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
-                add_features(features, VM, pos_dict,IDM, 'VM', tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
+                add_features(features, OM, IDM, 'OM', encoder, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id)
+                add_features(features, VM, IDM, 'VM', encoder, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id)
             
-                add_features(features, IM, pos_dict,IDM, 'IM', tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
-                add_features(features, TIM, pos_dict,IDM, 'TIM', tokenizer , texts, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left)
+                add_features(features, IM, IDM, 'IM', encoder, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id)
+                add_features(features, TIM, IDM, 'TIM', encoder, example.doc_id[len(example.doc_id)-4:len(example.doc_id)], example.sen_id)
 
-    print("remove number", remove_count)
-    print("sucessfully loading data!!!!!!!!!!!!!!!!!!!")
-    print("sum of rule BBB",sum_BBB)
-    print("sum of rule BOB",sum_BOB)
-    print("sum of rule OBB",sum_OBB)
-    print("sum of rule OOO",sum_OOO)
-    #exit()
+    if triple_rows:
+        logger.info("Encoded %d distinct pairs for %d triple rows" % (memo.misses, triple_rows))
+    return features, dict_IndenToID, remove_count, (sum_BBB, sum_BOB, sum_OBB, sum_OOO)
+
+
+def duplicate_window_pairs(examples):
+    '''
+    for overlapping i2b2 windows, the (id, id) event pairs of every example whose canonical window is another
+    one; a gold pair is kept in the window where its events are closest to the middle sentence, then in the
+    window with the fewest words, then in the first
+    '''
+    best = {}
+    ranked = []
+    for order, example in enumerate(examples):
+        starts = np.cumsum([0] + [len(text) for text in example.text])
+        middle = (len(example.text) - 1) / 2
+        pairs = {}
+        for r in example.relations:
+            # r[0] and r[3] are the first words of the two events in the merged window
+            sentences = np.searchsorted(starts, [r[0], r[3]], side = 'right') - 1
+            rank = (float(np.abs(sentences - middle).sum()), int(starts[-1]), order)
+            pairs[tuple(sorted((r[2], r[5])))] = rank
+        for pair, rank in pairs.items():
+            key = (str(example.doc_id), pair)
+            if key not in best or rank < best[key]:
+                best[key] = rank
+        ranked.append(pairs)
+    return [set(pair for pair, rank in pairs.items() if best[(str(example.doc_id), pair)] != rank)
+            for example, pairs in zip(examples, ranked)]
+
+
+def duplicate_pair_mask(example, IDToIndex):
+    '''
+    n*n mask of the event pairs of example that duplicate_window_pairs gives to another window, both
+    directions; None when there are none
+    '''
+    pairs = getattr(example, 'duplicate_pairs', None)
+    if not pairs:
+        return None
+    mask = np.zeros((len(IDToIndex), len(IDToIndex)), dtype = bool)
+    for x, y in pairs:
+        mask[IDToIndex[x], IDToIndex[y]] = mask[IDToIndex[y], IDToIndex[x]] = True
+    return mask
+
+
+_worker_tokenizer = None
+
+def _init_convert_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(1)
+
+
+def _convert_shard(shard):
+    convert_fn, start_index, examples, convert_args = shard
+    return convert_fn(examples, _worker_tokenizer, start_index=start_index, **convert_args)
+
+
+def parallel_convert_examples(examples, tokenizer, num_workers, convert_args, convert_fn=None):
+    """
+    Shards the examples by document across a process pool and returns the per-shard results of
+    ``convert_fn`` (``sb_convert_chunk`` by default) in example order. Each worker gets its own copy
+    of the tokenizer and single-threaded BLAS, so the pool does not oversubscribe the cores.
+    """
+    if convert_fn is None:
+        convert_fn = sb_convert_chunk
+    shards = []
+    for ex_index, example in enumerate(examples):
+        if not shards or str(example.doc_id) != str(shards[-1][2][-1].doc_id):
+            shards.append((convert_fn, ex_index, [], convert_args))
+        shards[-1][2].append(example)
+    logger.info("Converting %d documents with %d workers" % (len(shards), num_workers))
+
+    # BLAS reads its thread count when the worker imports numpy
+    blas_vars = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+    saved_env = {var: os.environ.get(var) for var in blas_vars}
+    for var in blas_vars:
+        os.environ[var] = '1'
+    try:
+        pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_convert_worker, initargs=(tokenizer,))
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+    with pool:
+        # imap keeps the shard order, which keeps the merge deterministic
+        results = list(pool.imap(_convert_shard, shards))
+    return results
+
+
+# labels of the pairs (A-B, B-C, A-C) for rules 1-7, see TripleAssembler.add_triangles; rule 0 means no rule
+# exists. model_layers.RULE_RELATIONS is this table as a tensor
+RULE_LABELS = np.array([
+    [0,0,0],
+    [1,1,1],
+    [2,2,2],
+    [1,0,1],
+    [0,2,2],
+    [0,1,1],
+    [2,0,2],
+    [0,0,0],
+], dtype = np.int64)
+
+
+def window_convert_examples_to_features(examples, tokenizer,
+                                      max_length=64,
+                                      pad_on_left=False,
+                                      pad_token=0,
+                                      pad_token_segment_id=0,
+                                      mask_padding_with_zero=True,
+                                      evaluate = False,
+                                      aug_round = 0,
+                                      tbd = False,
+                                      num_workers = 0,
+                                      ):
+    """
+    Loads a data file into a list of ``Input_Window_Features``, one per context window, for the
+    shared-encoder model. The labelled pairs are the ones ``sb_convert_examples_to_features`` produces
+    for the same split; the triples are every triple of labelled pairs that follows a rule.
+
+    Returns:
+        the features and dict_IndenToID
+    """
+    convert_args = dict(max_length=max_length, pad_on_left=pad_on_left, pad_token=pad_token,
+                        pad_token_segment_id=pad_token_segment_id, mask_padding_with_zero=mask_padding_with_zero,
+                        evaluate=evaluate, aug_round=aug_round, tbd=tbd)
+    if num_workers > 1:
+        results = parallel_convert_examples(examples, tokenizer, num_workers, convert_args, convert_fn=window_convert_chunk)
+    else:
+        results = [window_convert_chunk(examples, tokenizer, **convert_args)]
+
+    features = []
+    dict_IndenToID = {}
+    remove_count = 0
+    for chunk_features, chunk_dict, chunk_remove_count in results:
+        features.extend(chunk_features)
+        dict_IndenToID.update(chunk_dict)
+        remove_count += chunk_remove_count
+    logger.info("remove number %d", remove_count)
+    logger.info("windows %d pairs %d triples %d", len(features), sum(len(f.pairs) for f in features), sum(len(f.triples) for f in features))
     return features, dict_IndenToID
 
 
+def window_convert_chunk(examples, tokenizer,
+                     max_length=64,
+                     pad_on_left=False,
+                     pad_token=0,
+                     pad_token_segment_id=0,
+                     mask_padding_with_zero=True,
+                     evaluate = False,
+                     aug_round = 0,
+                     tbd = False,
+                     start_index = 0,
+                     ):
+    """
+    Converts a contiguous run of examples; see ``window_convert_examples_to_features``.
+    """
+    features = []
+    dict_IndenToID = {}
+    remove_count = 0
+
+    for (ex_index, example) in enumerate(examples, start_index):
+        if ex_index % 10000 == 0:
+            logger.info("Writing example %d" % (ex_index))
+
+        example.doc_id = str(example.doc_id)
+        doc_id = example.doc_id[len(example.doc_id)-4:len(example.doc_id)] if tbd else example.doc_id
+        IDToIndex, IndexToID = IDIndexDic(rel = example.relations)
+        dict_IndenToID[str(doc_id)+example.sen_id] = IndexToID
+
+        # the same matrices as sb_convert_chunk, in the order its features are written
+        if evaluate:
+            if tbd:
+                BM,AM, OM, IDM, pos_dict, VM, IM, TIM = build_BO_evaluate(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
+                label_matrices = [(BM, 1), (AM, 2), (VM, 3), (IM, 4), (TIM, 5)]
+            else:
+                BM,AM, OM, IDM, pos_dict, VM = build_BO_evaluate(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
+                label_matrices = [(BM, 1), (AM, 2), (OM, 0)]
+        else:
+            if tbd:
+                BM, OM, IDM, pos_dict, VM, IM = build_BO(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
+                BM, OM, IM, VM, remove_count = iter_rule_update_tbd(BM, OM, IM, VM,aug_round, remove_count, evaluate = False, closure = getattr(example, 'closure', None))
+                label_matrices = [(BM, 1), (BM.transpose(), 2), (VM, 3), (IM, 4), (IM.transpose(), 5)]
+            else:
+                BM, OM, IDM, pos_dict, VM = build_BO(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
+                BM, OM, remove_count = iter_rule_update(BM, OM, aug_round, remove_count, evaluate = False, closure = getattr(example, 'closure', None))
+                label_matrices = [(BM, 1), (BM.transpose(), 2), (OM, 0)]
+
+        pairs = []
+        for M, label in label_matrices:
+            all_x, all_y = np.where(M>0)
+            pairs.extend((int(x), int(y), label) for x, y in zip(all_x, all_y))
+        if not pairs:
+            continue
+        triples = [] if evaluate else window_triples(pairs, len(IDToIndex))
+
+        if tbd:
+            texts = example.text
+        else:
+            texts = []
+            for text in example.text:
+                texts.extend(text)
+        encoder = PairEncoder(tokenizer, texts, pos_dict, max_length, mask_padding_with_zero, pad_token, pad_token_segment_id, pad_on_left)
+        input_ids, attention_masks, token_type_ids, spans = encoder.encode_window()
+        entity_spans = [spans.get(i, (-1, -1)) for i in range(len(IDToIndex))]
+
+        features.append(
+            Input_Window_Features(input_ids=input_ids,
+                        attention_masks=attention_masks,
+                        token_type_ids=token_type_ids,
+                        entity_spans=entity_spans,
+                        pairs=pairs,
+                        triples=triples,
+                        doc_id=int(doc_id),
+                        sen_id=example.sen_id,
+                        ))
+
+    return features, dict_IndenToID, remove_count
+
+
+def window_triples(pairs, n):
+    '''
+    (A-B, B-C, A-C) pair indices and rule of every triple of labelled pairs whose labels follow a rule
+    '''
+    pair_index = np.full((n, n), -1)
+    for i, (x, y, r) in enumerate(pairs):
+        pair_index[x, y] = i
+    # a pair labelled twice keeps its last label, as its pair_index does
+    x, y = np.nonzero(pair_index >= 0)
+    label = np.asarray([pairs[i][2] for i in pair_index[x, y]], dtype = np.int64)
+    relations = {r: RelationMatrix.from_pairs(n, x[label == r], y[label == r]) for r in range(3)}
+    triples = []
+    for rule in range(1, len(RULE_LABELS)):
+        ab, bc, ac = RULE_LABELS[rule]
+        # the triangles come from the edges, never as a dense n*n*n tensor
+        for a, b, c in rule_triangles(relations[ab], relations[bc], relations[ac]):
+            if a != b and b != c and a != c:
+                triples.append((int(pair_index[a, b]), int(pair_index[b, c]), int(pair_index[a, c]), rule))
+    return triples
+
+
+def window_features_to_columns(features, tbd = False):
+    '''
+    window, pair and triple columns of a list of Input_Window_Features; pair and triple rows are grouped by
+    window and located through pair_offsets / triple_offsets, triple_pairs index the pair rows
+    '''
+    n_entities = max(len(f.entity_spans) for f in features)
+    entity_spans = np.full((len(features), n_entities, 2), -1, dtype = np.int32)
+    pair_offsets = np.zeros(len(features) + 1, dtype = np.int64)
+    triple_offsets = np.zeros(len(features) + 1, dtype = np.int64)
+    pair_events, labels, triple_pairs, rules = [], [], [], []
+    for i, f in enumerate(features):
+        entity_spans[i, :len(f.entity_spans)] = f.entity_spans
+        pair_events.extend((x, y) for x, y, _ in f.pairs)
+        labels.extend(r for _, _, r in f.pairs)
+        triple_pairs.extend((a + pair_offsets[i], b + pair_offsets[i], c + pair_offsets[i]) for a, b, c, _ in f.triples)
+        rules.extend(rule for _, _, _, rule in f.triples)
+        pair_offsets[i+1] = pair_offsets[i] + len(f.pairs)
+        triple_offsets[i+1] = triple_offsets[i] + len(f.triples)
+    attention_mask = np.asarray([f.attention_masks for f in features], dtype = np.int16)
+    return {
+        'input_ids': np.asarray([f.input_ids for f in features], dtype = np.int32),
+        'attention_mask': attention_mask,
+        'lengths': attention_mask.sum(axis = -1, dtype = np.int16),
+        'token_type_ids': np.asarray([f.token_type_ids for f in features], dtype = np.int16),
+        'entity_spans': entity_spans,
+        'doc_ids': np.asarray([f.doc_id for f in features], dtype = np.int32),
+        'sen_ids': np.asarray([parse_sen_id(f.sen_id, tbd) for f in features], dtype = np.int32),
+        'pair_offsets': pair_offsets,
+        'event_ids': np.asarray(pair_events, dtype = np.int32).reshape(-1, 2),
+        'labels': np.asarray(labels, dtype = np.int16),
+        'triple_offsets': triple_offsets,
+        'triple_pairs': np.asarray(triple_pairs, dtype = np.int64).reshape(-1, 3),
+        'rules': np.asarray(rules, dtype = np.int16),
+    }
+
+
+FEATURE_CACHE_MANIFEST = 'manifest.json'
+# bump when the featurization changes so stale caches are not reused
+FEATURE_CACHE_VERSION = 7
+
+# column name, feature attribute, dtype; rules, valid and triple_pairs only exist for the training triples,
+# which TripleAssembler writes as columns directly; node_pos is the position of the first token of e1 and e2
+# in input_ids, -1 when truncated
+FEATURE_COLUMNS = [
+    ('input_ids', 'input_ids', np.int32),
+    ('attention_mask', 'attention_masks', np.int16),
+    ('token_type_ids', 'token_type_ids', np.int16),
+    ('node_pos', 'node_pos', np.int16),
+    ('event_ids', 'ids', np.int32),
+    ('labels', 'relations', np.int16),
+    ('doc_ids', 'doc_id', np.int32),
+    ('sen_ids', 'sen_id', np.int32),
+    ('rules', 'rules', np.int16),
+    ('valid', None, np.int8),
+    ('triple_pairs', None, np.int64),
+]
+
+
+def feature_cache_key(data_file, tokenizer, settings):
+    '''
+    hash of everything the features depend on: the input JSON, the tokenizer vocab and the conversion settings;
+    tokenizer is None for caches that do not depend on it
+    '''
+    key = hashlib.sha1()
+    with open(data_file, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(1 << 20), b''):
+            key.update(chunk)
+    if tokenizer is not None:
+        vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        key.update('\n'.join(vocab).encode('utf-8'))
+    settings = dict(settings, version = FEATURE_CACHE_VERSION, tokenizer = type(tokenizer).__name__)
+    key.update(json.dumps(settings, sort_keys = True).encode('utf-8'))
+    return key.hexdigest()
+
+
+def parse_sen_id(sen_id, tbd = False):
+    '''
+    "[1:4)" (tbd) or "(0, 1, 2)" (i2b2) to a list of sentence numbers
+    '''
+    if tbd:
+        return [int(i) for i in sen_id[1:len(sen_id)-1].split(":")]
+    return [int(i) for i in sen_id[1:len(sen_id)-1].replace(':',', ').split(", ")]
+
+
+def features_to_columns(features, tbd = False, evaluate = False):
+    '''
+    stack a list of Input_SB_Features into fixed-width numpy columns, parsing the sen_ids once; the training
+    triples already come as column blocks per window and are concatenated: input_ids, attention_mask,
+    token_type_ids and node_pos hold the distinct pairs and triple_pairs the three pair rows of every triple;
+    lengths holds the number of real tokens of every pair row
+    '''
+    columns = {}
+    # the triples of a window index its own pair rows, which start at pair_offsets in the concatenated table
+    pair_offsets = np.cumsum([0] + [len(block['input_ids']) for block in features[:-1]]) if not evaluate else None
+    for name, attr, dtype in FEATURE_COLUMNS:
+        if not evaluate and name == 'triple_pairs':
+            columns[name] = np.concatenate([block[name] + offset for block, offset in zip(features, pair_offsets)])
+            continue
+        if not evaluate:
+            columns[name] = np.concatenate([block[name] for block in features])
+            continue
+        if name in ['rules', 'valid', 'triple_pairs']:
+            continue
+        if name == 'sen_ids':
+            values = [parse_sen_id(f.sen_id, tbd) for f in features]
+        else:
+            values = [getattr(f, attr) for f in features]
+        columns[name] = np.asarray(values, dtype = dtype)
+    # unpadded length of every row, for batching by length
+    columns['lengths'] = columns['attention_mask'].sum(axis = -1, dtype = np.int16)
+    return columns
+
+
+def save_feature_cache(cache_dir, columns, dict_IndenToID):
+    '''
+    write each column as a .npy file plus a JSON manifest with the column order, dtypes and shapes
+    '''
+    tmp_dir = cache_dir + '.tmp'
+    os.makedirs(tmp_dir, exist_ok = True)
+    manifest = {'num_features': len(columns['input_ids']), 'columns': []}
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), column)
+        manifest['columns'].append({'name': name, 'dtype': column.dtype.name, 'shape': list(column.shape)})
+    with open(os.path.join(tmp_dir, 'dict_IndenToID.json'), 'w') as writer:
+        json.dump(dict_IndenToID, writer)
+    with open(os.path.join(tmp_dir, FEATURE_CACHE_MANIFEST), 'w') as writer:
+        json.dump(manifest, writer, indent = 2)
+    # the manifest is written last and the directory renamed, so a partial cache is never picked up
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def load_feature_cache(cache_dir):
+    '''
+    memory-map the columns written by save_feature_cache; nothing is read until a row is indexed
+    '''
+    with open(os.path.join(cache_dir, FEATURE_CACHE_MANIFEST)) as reader:
+        manifest = json.load(reader)
+    columns = {}
+    for column in manifest['columns']:
+        # copy-on-write so torch.from_numpy gets a writable array without copying the file
+        array = np.load(os.path.join(cache_dir, column['name'] + '.npy'), mmap_mode = 'c')
+        if array.dtype.name != column['dtype'] or list(array.shape) != column['shape']:
+            raise ValueError("Feature cache column %s does not match %s" % (column['name'], cache_dir))
+        columns[column['name']] = array
+    with open(os.path.join(cache_dir, 'dict_IndenToID.json')) as reader:
+        dict_IndenToID = {key: {int(i): event for i, event in IndexToID.items()} for key, IndexToID in json.load(reader).items()}
+    return columns, dict_IndenToID
+
+
+def window_closure(example, tbd = False):
+    '''
+    the closure of the relations of an example with the round every edge is derived in, computed once and
+    filtered to aug_round by iter_rule_update / iter_rule_update_tbd (see temporal_closure.closure_rounds)
+    '''
+    IDToIndex, _ = IDIndexDic(rel = example.relations)
+    if tbd:
+        BM, OM, IDM, pos_dict, VM, IM = build_BO(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
+        return tbd_closure_rounds(BM, OM, IM, VM)
+    BM, OM, IDM, pos_dict, VM = build_BO(rel = example.relations, IDToIndex= IDToIndex, tbd = tbd)
+    return closure_rounds(BM, OM)
+
+
+def save_closure_cache(cache_file, closures):
+    '''
+    write the window_closure of every example to one .npz: the n*n round matrices are flattened and
+    concatenated, with the window sizes to split them again
+    '''
+    matrices = [name for name in closures[0] if name != 'failed_round'] if closures else []
+    arrays = {'sizes': np.asarray([closure[matrices[0]].shape[0] for closure in closures] if matrices else [], dtype = np.int64),
+              'failed_round': np.asarray([closure['failed_round'] for closure in closures], dtype = np.int64)}
+    for name in matrices:
+        arrays[name] = np.concatenate([closure[name].ravel() for closure in closures])
+    # np.savez adds the .npz suffix; the file is renamed into place so a partial cache is never picked up
+    np.savez(cache_file + '.tmp', **arrays)
+    os.replace(cache_file + '.tmp.npz', cache_file)
+
+
+def load_closure_cache(cache_file):
+    '''
+    the list of window_closure written by save_closure_cache
+    '''
+    with np.load(cache_file) as arrays:
+        arrays = {name: arrays[name] for name in arrays.files}
+    sizes, failed_round = arrays.pop('sizes'), arrays.pop('failed_round')
+    offsets = np.concatenate(([0], np.cumsum(sizes * sizes)))
+    return [dict({name: values[offsets[i]:offsets[i+1]].reshape(n, n) for name, values in arrays.items()},
+                 failed_round = int(failed_round[i]))
+            for i, n in enumerate(sizes)]
+
+
 def graph_convert_examples_to_features2(examples, tokenizer,
                                       max_length=64,
                                       task=None,
@@ -1380,7 +1939,255 @@ def build_PSL_dataset(adj = None, rel = None, no_rule = True ,random_sampling =
 
     return emb
 
-def add_features(features,M, pos_dict,IDM, M_type, tokenizer , texts,doc_id ,sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left):
+
+# inline entity markers of the pair encoders
+ENTITY_MARKERS = ['<e1>', '</e1>', '<e2>', '</e2>']
+
+
+def _find_ids(ids, pattern):
+    '''
+    index of the first occurrence of the id sequence pattern in ids, -1 if it does not occur
+    '''
+    first = pattern[0]
+    for i, token in enumerate(ids):
+        if token == first and ids[i:i+len(pattern)] == pattern:
+            return i
+    return -1
+
+
+def add_entity_markers(tokenizer, model = None):
+    '''
+    register the entity markers as additional special tokens so each is encoded as one id instead of
+    about four word pieces, and resize the embeddings of model to the new vocabulary
+    '''
+    markers = [m for m in ENTITY_MARKERS if m not in tokenizer.additional_special_tokens]
+    if markers:
+        tokenizer.add_special_tokens({'additional_special_tokens': tokenizer.additional_special_tokens + markers})
+    if model is not None:
+        model.resize_token_embeddings(len(tokenizer))
+    return tokenizer
+
+
+class PairEncoder(object):
+    """
+    Encodes the entity pairs of one context window with inline entity markers.
+
+    The window is word-piece tokenized once and a word-to-subword offset map is kept;
+    the ``input_ids`` of a pair are then built by splicing the marker ids into the cached
+    token sequence, which gives the same ids as calling ``encode_plus`` on the marked text.
+
+    Args:
+        tokenizer: Instance of a tokenizer that will tokenize the window
+        texts: list of words of the window
+        pos_dict: dict from event index to its (start, end) word span
+        max_length: Maximum example length
+        joiner: string used to join the words, ``' '`` or ``''`` when the words already carry
+            their trailing whitespace (ACROBAT)
+        truncation: ``right`` cuts a pair longer than ``max_length`` from the right as ``encode_plus`` does;
+            ``entity`` keeps both marked entities and the tokens between them, filling the rest of the
+            budget with balanced left and right context, or drops the middle of the gap between the
+            entities when they are too far apart
+    """
+
+    def __init__(self, tokenizer, texts, pos_dict, max_length,
+                 mask_padding_with_zero=True, pad_token=0, pad_token_segment_id=0, pad_on_left=False,
+                 joiner=' ', truncation='right'):
+        self.tokenizer = tokenizer
+        self.texts = texts
+        self.pos_dict = pos_dict
+        self.max_length = max_length
+        self.mask_padding_with_zero = mask_padding_with_zero
+        self.pad_token = pad_token
+        self.pad_token_segment_id = pad_token_segment_id
+        self.pad_on_left = pad_on_left
+        self.joiner = joiner
+        self.truncation = truncation
+        self.num_added_tokens = tokenizer.num_added_tokens()
+
+        # markers are written as separate words, so they are word-piece tokenized on their own
+        marker_suffix = '' if joiner.isspace() else ' '
+        self.markers = {m: tokenizer.convert_tokens_to_ids(tokenizer.tokenize(m + marker_suffix))
+                        for m in ENTITY_MARKERS}
+        # registered as special tokens (add_entity_markers) every marker is a single id found in input_ids
+        self.marker_ids = None
+        if all(m in tokenizer.additional_special_tokens for m in ENTITY_MARKERS):
+            self.marker_ids = {m: ids[0] for m, ids in self.markers.items()}
+            self.special_ids = set(tokenizer.all_special_ids)
+
+        # splicing is only exact when every word boundary is a whitespace boundary
+        self.cached = joiner.isspace() or all(t[-1:].isspace() for t in texts[:-1])
+        self.token_ids = []
+        self.offsets = [0]
+        for word in texts:
+            self.token_ids.extend(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word)))
+            self.offsets.append(len(self.token_ids))
+
+    def _span(self, start, end):
+        '''
+        subword ids of texts[start:end]
+        '''
+        n = len(self.texts)
+        start, end = min(max(start, 0), n), min(max(end, 0), n)
+        return self.token_ids[self.offsets[start]:self.offsets[end]]
+
+    def _marked_ids(self, e1, e2):
+        '''
+        token ids of the window with markers around e1 and e2, and the index of the first token of each entity
+        '''
+        x1, x2 = self.pos_dict[e1]
+        y1, y2 = self.pos_dict[e2]
+        first, second = ('<e1>', '</e1>'), ('<e2>', '</e2>')
+        if x1 > y1:
+            x1,x2,y1,y2 = y1,y2,x1,x2
+            first, second = second, first
+
+        if not self.cached:
+            texts, suffix = self.texts, '' if self.joiner.isspace() else ' '
+            new_text = texts[0:x1] + [first[0] + suffix] + texts[x1:(x2+1)] + [first[1] + suffix] + texts[(x2+1):y1] + [second[0] + suffix] + texts[y1:(y2+1)] + [second[1] + suffix] + texts[(y2+1):len(texts)]
+            ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(self.joiner.join(new_text)))
+            node_pos = []
+            for m in ['<e1>', '<e2>']:
+                position = _find_ids(ids, self.markers[m])
+                node_pos.append(position + len(self.markers[m]) if position >= 0 else -1)
+            return ids, tuple(node_pos)
+
+        segments = [self._span(0, x1), self.markers[first[0]], self._span(x1, x2+1), self.markers[first[1]],
+                    self._span(x2+1, y1), self.markers[second[0]], self._span(y1, y2+1), self.markers[second[1]],
+                    self._span(y2+1, len(self.texts))]
+        ids = []
+        starts = []
+        for segment in segments:
+            starts.append(len(ids))
+            ids.extend(segment)
+        node_pos = (starts[2], starts[6]) if first[0] == '<e1>' else (starts[6], starts[2])
+        return ids, node_pos
+
+    def encode(self, e1, e2):
+        '''
+        padded input_ids, attention_mask and token_type_ids for the pair (e1, e2), and the position
+        of the first token of e1 and e2 in input_ids (-1 when truncated)
+        '''
+        ids, node_pos = self._marked_ids(e1, e2)
+        if self.truncation == 'entity' and len(ids) > self.max_length - self.num_added_tokens:
+            ids, node_pos = self._entity_window(ids, node_pos)
+        input_id, attention_mask, token_type_id, shift = self._add_special_tokens_and_pad(ids)
+        if self.marker_ids is not None:
+            node_pos = tuple(self._after_marker(input_id, self.marker_ids[m]) for m in ['<e1>', '<e2>'])
+        else:
+            # an entity past the right truncation has no position
+            num_tokens = min(len(ids), self.max_length - self.num_added_tokens)
+            node_pos = tuple(p + shift if 0 <= p < num_tokens else -1 for p in node_pos)
+        return input_id, attention_mask, token_type_id, node_pos
+
+    def _entity_window(self, ids, node_pos):
+        '''
+        cut ids to the token budget around the two marked entities, and the index of the first token of each
+        entity in the cut ids; ids and node_pos are returned unchanged when a marker is missing or the entities
+        alone do not fit
+        '''
+        budget = self.max_length - self.num_added_tokens
+        found = {m: _find_ids(ids, self.markers[m]) for m in ENTITY_MARKERS}
+        if min(found.values()) < 0:
+            return ids, node_pos
+        # (start, end) of each marked entity, markers included, in text order
+        spans = sorted((found[open_m], found[close_m] + len(self.markers[close_m]))
+                       for open_m, close_m in [('<e1>', '</e1>'), ('<e2>', '</e2>')])
+        (first_start, first_end), (second_start, second_end) = spans
+        core = second_end - first_start
+        if core <= budget:
+            # the entities and everything between them, with the rest of the budget split over both sides
+            extra = budget - core
+            right_context = len(ids) - second_end
+            left = min(first_start, max(extra // 2, extra - right_context))
+            right = min(right_context, extra - left)
+            pieces = [(first_start - left, second_end + right)]
+        else:
+            gap = budget - (first_end - first_start) - (second_end - second_start)
+            if gap < 0:
+                return ids, node_pos
+            # keep the two ends of the gap between the entities next to them
+            pieces = [(first_start, first_end + gap // 2), (second_start - (gap - gap // 2), second_end)]
+
+        window = []
+        node_pos = []
+        for m in ['<e1>', '<e2>']:
+            position = found[m] + len(self.markers[m])
+            offset = 0
+            for start, end in pieces:
+                if start <= position < end:
+                    node_pos.append(offset + position - start)
+                    break
+                offset += end - start
+            else:
+                node_pos.append(-1)
+        for start, end in pieces:
+            window.extend(ids[start:end])
+        return window, tuple(node_pos)
+
+    def _after_marker(self, input_id, marker_id):
+        '''
+        position of the token after the marker in input_id, -1 when the marker or the entity is truncated
+        '''
+        if marker_id not in input_id:
+            return -1
+        position = input_id.index(marker_id) + 1
+        if position >= len(input_id) or input_id[position] in self.special_ids:
+            return -1
+        return position
+
+    def encode_window(self):
+        '''
+        padded input_ids, attention_mask and token_type_ids of the window without markers, and the
+        (start, end) token span of every event in input_ids, end exclusive, (-1, -1) when truncated
+        '''
+        ids = self.token_ids
+        input_id, attention_mask, token_type_id, shift = self._add_special_tokens_and_pad(ids)
+        num_tokens = min(len(ids), self.max_length - self.num_added_tokens)
+        n = len(self.texts)
+        spans = {}
+        for event, (x1, x2) in self.pos_dict.items():
+            start = self.offsets[min(max(x1, 0), n)]
+            end = min(self.offsets[min(max(x2+1, 0), n)], num_tokens)
+            spans[event] = (start + shift, end + shift) if start < end else (-1, -1)
+        return input_id, attention_mask, token_type_id, spans
+
+    def _add_special_tokens_and_pad(self, ids):
+        '''
+        truncate, add the special tokens and pad; also returns the shift of a position in ids to its position in input_id
+        '''
+        # truncate from the right as encode_plus does
+        num_tokens = self.max_length - self.num_added_tokens
+        if len(ids) > num_tokens:
+            ids = ids[:num_tokens]
+        input_id = self.tokenizer.build_inputs_with_special_tokens(ids)
+        token_type_id = self.tokenizer.create_token_type_ids_from_sequences(ids)
+        # [CLS] shifts every position by one
+        shift = 1
+
+        # The mask has 1 for real tokens and 0 for padding tokens. Only real
+        # tokens are attended to.
+        attention_mask = [1 if self.mask_padding_with_zero else 0] * len(input_id)
+
+        # Zero-pad up to the sequence length.
+        padding_length = self.max_length - len(input_id)
+        if self.pad_on_left:
+            input_id = ([self.pad_token] * padding_length) + input_id
+            attention_mask = ([0 if self.mask_padding_with_zero else 1] * padding_length) + attention_mask
+            token_type_id = ([self.pad_token_segment_id] * padding_length) + token_type_id
+            shift += padding_length
+        else:
+            input_id = input_id + ([self.pad_token] * padding_length)
+            attention_mask = attention_mask + ([0 if self.mask_padding_with_zero else 1] * padding_length)
+            token_type_id = token_type_id + ([self.pad_token_segment_id] * padding_length)
+
+        assert len(input_id) == self.max_length, "Error with input length {} vs {}".format(len(input_id), self.max_length)
+        assert len(attention_mask) == self.max_length, "Error with input length {} vs {}".format(len(attention_mask), self.max_length)
+        assert len(token_type_id) == self.max_length, "Error with input length {} vs {}".format(len(token_type_id), self.max_length)
+
+        return input_id, attention_mask, token_type_id, shift
+
+
+def add_features(features,M, IDM, M_type, encoder, doc_id ,sen_id):
     #print(doc_id)
     if M_type == "BM":
         r = 1
@@ -1398,51 +2205,7 @@ def add_features(features,M, pos_dict,IDM, M_type, tokenizer , texts,doc_id ,sen
 
 
     for i in range(all_x.size):
-        x1, x2 = pos_dict[all_x[i]]
-        y1, y2 = pos_dict[all_y[i]]
-        if x1 > y1:
-            x1,x2,y1,y2 = y1,y2,x1,x2
-            new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-            new_text = ' '.join(new_text)
-        else:
-            new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-            new_text = ' '.join(new_text)
-
-        inputs = tokenizer.encode_plus(
-            new_text,
-            add_special_tokens=True,
-            max_length=max_length,
-        )
-        node_pos_1 = node_pos_2 = -1
-        text = tokenizer.tokenize(new_text)
-        for j in range(len(text)-4):
-            if text[:4] == ['[', 'e', '##1', ']']:
-                node_pos_1 = j + 4
-            elif text[:4] == ['[', 'e', '##2', ']']:
-                node_pos_2 = j + 4
-
-        input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_length - len(input_id)
-
-        if pad_on_left:
-            input_id = ([pad_token] * padding_length) + input_id
-            attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-            token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-        else:
-            input_id = input_id + ([pad_token] * padding_length)
-            attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-        assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-        assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-        assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
+        input_id, attention_mask, token_type_id, node_pos = encoder.encode(all_x[i], all_y[i])
         sample_method = "closest"  # "random": retain all origin and random sample rest;"closest", retain origin and neighbor relation
         if IDM[all_x[i],all_y[i]]==2:
             # 2 means generated data, 1 origin data
@@ -1459,7 +2222,7 @@ def add_features(features,M, pos_dict,IDM, M_type, tokenizer , texts,doc_id ,sen
                         sen_id=int(sen_id),
                         ids=(all_x[i], all_y[i]),
                         sources = sources  ,
-                        node_pos = (node_pos_1, node_pos_2),
+                        node_pos = node_pos,
                         ))
             if sample_method == 'closest':
                 close_thre = 3
@@ -1473,7 +2236,7 @@ def add_features(features,M, pos_dict,IDM, M_type, tokenizer , texts,doc_id ,sen
                         sen_id=int(sen_id),
                         ids=(all_x[i], all_y[i]),
                         sources = sources  ,
-                        node_pos = (node_pos_1, node_pos_2),
+                        node_pos = node_pos,
                         ))
         if IDM[all_x[i],all_y[i]]==1:
             sources = 1
@@ -1486,920 +2249,217 @@ def add_features(features,M, pos_dict,IDM, M_type, tokenizer , texts,doc_id ,sen
                         sen_id=sen_id,
                         ids=(all_x[i], all_y[i]),
                         sources = sources,
-                        node_pos = (node_pos_1, node_pos_2),
+                        node_pos = node_pos,
                         ))
 
-def add_features_triple(sum_BBB, sum_BOB, sum_OBB, sum_OOO, features,BM, OM,VM,IM, pos_dict,IDM, tokenizer , texts,doc_id ,sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left, tbd):
+def add_features_triple(sum_BBB, sum_BOB, sum_OBB, sum_OOO, assembler, BM, OM, VM, IM, encoder, tbd):
     '''
     add the features in triple form where all rules will be included and cases not inclued in any rule 
     will be combined together as a triple
     '''
-    B_count, O_count, B_red, O_red = 0, 0, 0, 0
-    # convert BM to a 3d tensor that BT[:,i,:] = BM for any i 
-    BT = np.tile(BM,(BM.shape[0],1,1))
-    BT = np.moveaxis(BT, 0,1)
-    OT = np.tile(OM,(OM.shape[0],1,1))
-    OT = np.moveaxis(OT, 0,1)
-    
-    # rule tensor find where ij, jk has link, BT find ik has link
-    BBB = rule_tensor(BM, BM) * BT
-    BOB = rule_tensor(BM, OM) * BT
-    OBB = rule_tensor(OM, BM) * BT
-    OOO = rule_tensor(OM, OM) * OT
-
-    sum_BBB += np.sum(BBB)
-    sum_BOB += np.sum(BOB)
-    sum_OBB += np.sum(OBB)
-    sum_OOO += np.sum(OOO)
-    All_rules = BBB+BOB+OBB+OOO
-    all_x, all_y, all_z = np.where(All_rules>0)
-    all_xyz = np.concatenate( (all_x.reshape(all_x.shape[0],1), all_y.reshape(all_y.shape[0],1), all_z.reshape(all_z.shape[0],1)), axis = 1)
-
-    B_x, B_y = np.where(BM>0)
-    B_xy = np.concatenate((B_x.reshape(B_x.shape[0],1), B_y.reshape(B_y.shape[0], 1)), axis = 1)
-    O_x, O_y = np.where(OM>0)
-    O_xy = np.concatenate((O_x.reshape(O_x.shape[0],1), O_y.reshape(O_y.shape[0], 1)), axis = 1)
-
-    V_x, V_y = np.where(VM>0)
-    
-    # complete the not used index to mod3=0
-    if len(V_x) % 3 == 2:
-        V_x = np.append(V_x, V_x[0:1])
-        V_y = np.append(V_y, V_y[0:1])
-    if len(V_x) % 3 ==1:
-        V_x = np.append(V_x, V_x[0:1])
-        V_y = np.append(V_y, V_y[0:1])
-        V_x = np.append(V_x, V_x[0:1])
-        V_y = np.append(V_y, V_y[0:1])
+    B_rel, O_rel = RelationMatrix.from_dense(BM), RelationMatrix.from_dense(OM)
+    # (x, y, z) of every rule where xy, yz has link and xz has link
+    BBB = rule_triangles(B_rel, B_rel, B_rel)
+    BOB = rule_triangles(B_rel, O_rel, B_rel)
+    OBB = rule_triangles(O_rel, B_rel, B_rel)
+    OOO = rule_triangles(O_rel, O_rel, O_rel)
+
+    sum_BBB += BBB.shape[0]
+    sum_BOB += BOB.shape[0]
+    sum_OBB += OBB.shape[0]
+    sum_OOO += OOO.shape[0]
 
     # add the no rules data
-    if len(V_x)==0:
-        pass
-    else:
-        for k in range(int(len(V_x)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((V_x[i],V_y[i]))
-                x1, x2 = pos_dict[V_x[i]]
-                y1, y2 = pos_dict[V_y[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
-
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
-
-            sources = 1
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[3,3,3],
-                        doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                        sen_id=[sen_id,sen_id,sen_id],
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0,0],
-                        ))
-
+    assembler.add_edges(*np.where(VM>0), 3, encoder)
     if tbd:
-        I_x, I_y = np.where(IM>0)
-        
-        # complete the not used index to mod3=0
-        if len(I_x) % 3 == 2:
-            I_x = np.append(I_x, I_x[0:1])
-            I_y = np.append(I_y, I_y[0:1])
-        if len(I_x) % 3 ==1:
-            I_x = np.append(I_x, I_x[0:1])
-            I_y = np.append(I_y, I_y[0:1])
-            I_x = np.append(I_x, I_x[0:1])
-            I_y = np.append(I_y, I_y[0:1])
-
-        # add the no rules data
-        if len(I_x)==0:
-            pass
-        else:
-            for k in range(int(len(I_x)/3)):
-                input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-                for i in [3*k, 3*k+1, 3*k+2]:
-                    ids.append((I_x[i],I_y[i]))
-                    x1, x2 = pos_dict[I_x[i]]
-                    y1, y2 = pos_dict[I_y[i]]
-                    if x1 > y1:
-                        x1,x2,y1,y2 = y1,y2,x1,x2
-                        new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                        new_text = ' '.join(new_text)
-                    else:
-                        new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                        new_text = ' '.join(new_text)
-                    
-                    inputs = tokenizer.encode_plus(
-                        new_text,
-                        add_special_tokens=True,
-                        max_length=max_length,
-                    )
-                    node_pos_1 = node_pos_2 = -1
-                    text = tokenizer.tokenize(new_text)
-                    for j in range(len(text)-4):
-                        if text[:4] == ['[', 'e', '##1', ']']:
-                            node_pos_1 = j + 4
-                        elif text[:4] == ['[', 'e', '##2', ']']:
-                            node_pos_2 = j + 4
-
-                    input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                    attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                    # Zero-pad up to the sequence length.
-                    padding_length = max_length - len(input_id)
-
-                    if pad_on_left:
-                        input_id = ([pad_token] * padding_length) + input_id
-                        attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                        token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                    else:
-                        input_id = input_id + ([pad_token] * padding_length)
-                        attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                        token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                    assert len(input_id) == max_length, "Error with input length {} Is {}".format(len(input_id), max_length)
-                    assert len(attention_mask) == max_length, "Error with input length {} Is {}".format(len(attention_mask), max_length)
-                    assert len(token_type_id) == max_length, "Error with input length {} Is {}".format(len(token_type_id), max_length)
-
-                    input_ids.append(input_id)
-                    token_type_ids.append(token_type_id)
-                    attention_masks.append(attention_mask)
-
-                sources = 1
-                features.append(
-                Input_SB_Features(input_ids=input_ids,
-                            attention_masks=attention_masks,
-                            token_type_ids=token_type_ids,
-                            relations=[4,4,4],
-                            doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                            sen_id=[sen_id,sen_id,sen_id],
-                            ids=ids,
-                            sources = [sources,sources,sources],
-                            rules = [0,0,0],
-                            ))
-        TIM = IM.transpose()
-        TI_x, TI_y = np.where(TIM>0)
-        
-        # complete the not used index to mod3=0
-        if len(TI_x) % 3 == 2:
-            TI_x = np.append(TI_x, TI_x[0:1])
-            TI_y = np.append(TI_y, TI_y[0:1])
-        if len(TI_x) % 3 ==1:
-            TI_x = np.append(TI_x, TI_x[0:1])
-            TI_y = np.append(TI_y, TI_y[0:1])
-            TI_x = np.append(TI_x, TI_x[0:1])
-            TI_y = np.append(TI_y, TI_y[0:1])
-
-        # add the no rules data
-        if len(TI_x)==0:
-            pass
-        else:
-            for k in range(int(len(TI_x)/3)):
-                input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-                for i in [3*k, 3*k+1, 3*k+2]:
-                    ids.append((TI_x[i],TI_y[i]))
-                    x1, x2 = pos_dict[TI_x[i]]
-                    y1, y2 = pos_dict[TI_y[i]]
-                    if x1 > y1:
-                        x1,x2,y1,y2 = y1,y2,x1,x2
-                        new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                        new_text = ' '.join(new_text)
-                    else:
-                        new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                        new_text = ' '.join(new_text)
-                    
-                    inputs = tokenizer.encode_plus(
-                        new_text,
-                        add_special_tokens=True,
-                        max_length=max_length,
-                    )
-                    node_pos_1 = node_pos_2 = -1
-                    text = tokenizer.tokenize(new_text)
-                    for j in range(len(text)-4):
-                        if text[:4] == ['[', 'e', '##1', ']']:
-                            node_pos_1 = j + 4
-                        elif text[:4] == ['[', 'e', '##2', ']']:
-                            node_pos_2 = j + 4
-
-                    input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                    attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                    # Zero-pad up to the sequence length.
-                    padding_length = max_length - len(input_id)
-
-                    if pad_on_left:
-                        input_id = ([pad_token] * padding_length) + input_id
-                        attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                        token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                    else:
-                        input_id = input_id + ([pad_token] * padding_length)
-                        attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                        token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                    assert len(input_id) == max_length, "Error with input length {} TIs {}".format(len(input_id), max_length)
-                    assert len(attention_mask) == max_length, "Error with input length {} TIs {}".format(len(attention_mask), max_length)
-                    assert len(token_type_id) == max_length, "Error with input length {} TIs {}".format(len(token_type_id), max_length)
-
-                    input_ids.append(input_id)
-                    token_type_ids.append(token_type_id)
-                    attention_masks.append(attention_mask)
-
-                sources = 1
-                features.append(
-                Input_SB_Features(input_ids=input_ids,
-                            attention_masks=attention_masks,
-                            token_type_ids=token_type_ids,
-                            relations=[5,5,5],
-                            doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                            sen_id=[sen_id,sen_id,sen_id],
-                            ids=ids,
-                            sources = [sources,sources,sources],
-                            rules = [0,0,0],
-                            ))
-
-
-
-    # get relations that not used
-    B_list = [any([x[0] in y and x[1] in y for y in all_xyz]) for x in B_xy]
-    B_index = [i for i, x in enumerate(B_list) if x == False]
-    O_list = [any([x[0] in y and x[1] in y for y in all_xyz]) for x in O_xy]
-    O_index = [i for i, x in enumerate(O_list) if x == False]
-
-
-    # complete the not used index to mod3=0
-    if len(B_index) % 3 == 2:
-        B_index.append(B_index[len(B_index)-1])
-        B_x = np.append(B_x, B_x[0:1])
-        B_y = np.append(B_y, B_y[0:1])
-    if len(B_index) % 3 ==1:
-        B_index.append(B_index[len(B_index)-1])
-        B_index.append(B_index[len(B_index)-1])
-        B_x = np.append(B_x, B_x[0:1])
-        B_y = np.append(B_y, B_y[0:1])
-        B_x = np.append(B_x, B_x[0:1])
-        B_y = np.append(B_y, B_y[0:1])
-
-    # add the no rules data
-    if len(B_index)==0:
-        pass
-    else:
-        for k in range(int(len(B_index)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((B_x[i],B_y[i]))
-                x1, x2 = pos_dict[B_x[i]]
-                y1, y2 = pos_dict[B_y[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
-
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
-
-            sources = 1
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[1,1,1],
-                        doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                        sen_id=[sen_id,sen_id,sen_id],
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0,0],
-                        ))
-            B_count+=3
-            B_red+=3
-
-    # add A no rules
-    if len(B_index)==0:
-        pass
-    else:
-        for k in range(int(len(B_index)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((B_y[i],B_x[i]))
-                x1, x2 = pos_dict[B_y[i]]
-                y1, y2 = pos_dict[B_x[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
-
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
-
-            sources = 1
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[2,2,2],
-                        doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                        sen_id=[sen_id,sen_id,sen_id],
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0, 0],
-                        ))
-            B_count+=3
-            B_red+=3
-
-
-   # complete the O no rules
-    if len(O_index) % 3 == 2:
-        O_index.append(O_index[len(O_index)-1])
-        O_x = np.append(O_x, O_x[0:1])
-        O_y = np.append(O_y, O_y[0:1])
-    if len(O_index) % 3 ==1:
-        O_index.append(O_index[len(O_index)-1])
-        O_x = np.append(O_x, O_x[0:1])
-        O_y = np.append(O_y, O_y[0:1])
-        O_x = np.append(O_x, O_x[0:1])
-        O_y = np.append(O_y, O_y[0:1])
-
-    # add O no rules
-    if len(O_index)==0:
-        pass
-    else:
-        for k in range(int(len(O_index)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((O_x[i],O_y[i]))
-                x1, x2 = pos_dict[O_x[i]]
-                y1, y2 = pos_dict[O_y[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                    new_text = ' '.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
+        assembler.add_edges(*np.where(IM>0), 4, encoder)
+        assembler.add_edges(*np.where(IM.transpose()>0), 5, encoder)
 
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
-
-            sources = 1 
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[0,0,0],
-                        doc_id=[int(doc_id)]*3,
-                        sen_id=[sen_id]*3,
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0,0],
-                        #node_pos = (node_pos_1, node_pos_2),
-                        ))
-            O_count+=3
-            O_red+=3
-
-
-    # add triple for rules
-    B_count, O_count = add_rules(BBB, 1,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(BBB, 2,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(BOB, 3,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(BOB, 4,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(OBB, 5,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(OBB, 6,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(OOO, 7,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
+    add_leftover_edges(assembler, BBB, BOB, OBB, OOO, B_rel, O_rel, encoder)
+    add_rule_triangles(assembler, BBB, BOB, OBB, OOO, encoder)
 
     return sum_BBB, sum_BOB, sum_OBB, sum_OOO
  
 
-def add_features_triple_ACROBAT(sum_BBB, sum_BOB, sum_OBB, sum_OOO, features,BM, OM, pos_dict,IDM, tokenizer , texts,doc_id ,sen_id, max_length,mask_padding_with_zero,pad_token,pad_token_segment_id,pad_on_left):
+def add_features_triple_ACROBAT(sum_BBB, sum_BOB, sum_OBB, sum_OOO, assembler, BM, OM, encoder, acrobat_encoder):
     '''
     add the features in triple form where all rules will be included and cases not inclued in any rule 
     will be combined together as a triple
+    the rule triples are encoded with encoder (space joined words) and the rest with acrobat_encoder
     '''
-    B_count, O_count, B_red, O_red = 0, 0, 0, 0
-    # convert BM to a 3d tensor that BT[:,i,:] = BM for any i 
-    BT = np.tile(BM,(BM.shape[0],1,1))
-    BT = np.moveaxis(BT, 0,1)
-    OT = np.tile(OM,(OM.shape[0],1,1))
-    OT = np.moveaxis(OT, 0,1)
-    # rule tensor find where ij, jk has link, BT find ik has link
-    BBB = rule_tensor(BM, BM) * BT
-    BOB = rule_tensor(BM, OM) * BT
-    OBB = rule_tensor(OM, BM) * BT
-    OOO = rule_tensor(OM, OM) * OT
-
-    sum_BBB += np.sum(BBB)
-    sum_BOB += np.sum(BOB)
-    sum_OBB += np.sum(OBB)
-    sum_OOO += np.sum(OOO)
-    All_rules = BBB+BOB+OBB+OOO
-    all_x, all_y, all_z = np.where(All_rules>0)
-    all_xyz = np.concatenate( (all_x.reshape(all_x.shape[0],1), all_y.reshape(all_y.shape[0],1), all_z.reshape(all_z.shape[0],1)), axis = 1)
-
-    B_x, B_y = np.where(BM>0)
-    B_xy = np.concatenate((B_x.reshape(B_x.shape[0],1), B_y.reshape(B_y.shape[0], 1)), axis = 1)
-    O_x, O_y = np.where(OM>0)
-    O_xy = np.concatenate((O_x.reshape(O_x.shape[0],1), O_y.reshape(O_y.shape[0], 1)), axis = 1)
-
-    # get relations that not used
-    B_list = [any([x[0] in y and x[1] in y for y in all_xyz]) for x in B_xy]
-    B_index = [i for i, x in enumerate(B_list) if x == False]
-    O_list = [any([x[0] in y and x[1] in y for y in all_xyz]) for x in O_xy]
-    O_index = [i for i, x in enumerate(O_list) if x == False]
-
-    # complete the not used index to mod3=0
-    if len(B_index) % 3 == 2:
-        B_index.append(B_index[len(B_index)-1])
-        B_x = np.append(B_x, B_x[0:1])
-        B_y = np.append(B_y, B_y[0:1])
-    if len(B_index) % 3 ==1:
-        B_index.append(B_index[len(B_index)-1])
-        B_index.append(B_index[len(B_index)-1])
-        B_x = np.append(B_x, B_x[0:1])
-        B_y = np.append(B_y, B_y[0:1])
-        B_x = np.append(B_x, B_x[0:1])
-        B_y = np.append(B_y, B_y[0:1])
-
-    # add the no rules data
-    if len(B_index)==0:
-        pass
-    else:
-        for k in range(int(len(B_index)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((B_x[i],B_y[i]))
-                x1, x2 = pos_dict[B_x[i]]
-                y1, y2 = pos_dict[B_y[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2> '] + texts[x1:(x2+1)] + ['</e2> '] + texts[(x2+1):y1] + ['<e1> '] + texts[y1:(y2+1)] + ['</e1> '] + texts[(y2+1):len(texts)]
-                    new_text = ''.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1> '] + texts[x1:(x2+1)] + ['</e1> '] + texts[(x2+1):y1] + ['<e2> '] + texts[y1:(y2+1)] + ['</e2> '] + texts[(y2+1):len(texts)]
-                    new_text = ''.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
-
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
-
-            sources = 1
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[1,1,1],
-                        doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                        sen_id=[sen_id,sen_id,sen_id],
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0,0],
-                        ))
-            B_count+=3
-            B_red+=3
-
-    # add A no rules
-    if len(B_index)==0:
-        pass
-    else:
-        for k in range(int(len(B_index)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((B_y[i],B_x[i]))
-                x1, x2 = pos_dict[B_y[i]]
-                y1, y2 = pos_dict[B_x[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2> '] + texts[x1:(x2+1)] + ['</e2> '] + texts[(x2+1):y1] + ['<e1> '] + texts[y1:(y2+1)] + ['</e1> '] + texts[(y2+1):len(texts)]
-                    new_text = ''.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1> '] + texts[x1:(x2+1)] + ['</e1> '] + texts[(x2+1):y1] + ['<e2> '] + texts[y1:(y2+1)] + ['</e2> '] + texts[(y2+1):len(texts)]
-                    new_text = ''.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
+    B_rel, O_rel = RelationMatrix.from_dense(BM), RelationMatrix.from_dense(OM)
+    # (x, y, z) of every rule where xy, yz has link and xz has link
+    BBB = rule_triangles(B_rel, B_rel, B_rel)
+    BOB = rule_triangles(B_rel, O_rel, B_rel)
+    OBB = rule_triangles(O_rel, B_rel, B_rel)
+    OOO = rule_triangles(O_rel, O_rel, O_rel)
 
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
+    sum_BBB += BBB.shape[0]
+    sum_BOB += BOB.shape[0]
+    sum_OBB += OBB.shape[0]
+    sum_OOO += OOO.shape[0]
 
-            sources = 1
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[2,2,2],
-                        doc_id=[int(doc_id),int(doc_id),int(doc_id)],
-                        sen_id=[sen_id,sen_id,sen_id],
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0, 0],
-                        ))
-            B_count+=3
-            B_red+=3
-
-
-   # complete the O no rules
-    if len(O_index) % 3 == 2:
-        O_index.append(O_index[len(O_index)-1])
-        O_x = np.append(O_x, O_x[0:1])
-        O_y = np.append(O_y, O_y[0:1])
-    if len(O_index) % 3 ==1:
-        O_index.append(O_index[len(O_index)-1])
-        O_x = np.append(O_x, O_x[0:1])
-        O_y = np.append(O_y, O_y[0:1])
-        O_x = np.append(O_x, O_x[0:1])
-        O_y = np.append(O_y, O_y[0:1])
-
-    # add O no rules
-    if len(O_index)==0:
-        pass
-    else:
-        for k in range(int(len(O_index)/3)):
-            input_ids, token_type_ids, attention_masks, ids = [], [], [], []
-            for i in [3*k, 3*k+1, 3*k+2]:
-                ids.append((O_x[i],O_y[i]))
-                x1, x2 = pos_dict[O_x[i]]
-                y1, y2 = pos_dict[O_y[i]]
-                if x1 > y1:
-                    x1,x2,y1,y2 = y1,y2,x1,x2
-                    new_text = texts[0:x1] + ['<e2> '] + texts[x1:(x2+1)] + ['</e2> '] + texts[(x2+1):y1] + ['<e1> '] + texts[y1:(y2+1)] + ['</e1> '] + texts[(y2+1):len(texts)]
-                    new_text = ''.join(new_text)
-                else:
-                    new_text = texts[0:x1] + ['<e1> '] + texts[x1:(x2+1)] + ['</e1> '] + texts[(x2+1):y1] + ['<e2> '] + texts[y1:(y2+1)] + ['</e2> '] + texts[(y2+1):len(texts)]
-                    new_text = ''.join(new_text)
-                
-                inputs = tokenizer.encode_plus(
-                    new_text,
-                    add_special_tokens=True,
-                    max_length=max_length,
-                )
-                node_pos_1 = node_pos_2 = -1
-                text = tokenizer.tokenize(new_text)
-                for j in range(len(text)-4):
-                    if text[:4] == ['[', 'e', '##1', ']']:
-                        node_pos_1 = j + 4
-                    elif text[:4] == ['[', 'e', '##2', ']']:
-                        node_pos_2 = j + 4
-
-                input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-                attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
-
-                # Zero-pad up to the sequence length.
-                padding_length = max_length - len(input_id)
-
-                if pad_on_left:
-                    input_id = ([pad_token] * padding_length) + input_id
-                    attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                    token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-                else:
-                    input_id = input_id + ([pad_token] * padding_length)
-                    attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                    token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
-
-                assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-                assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-                assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
-
-                input_ids.append(input_id)
-                token_type_ids.append(token_type_id)
-                attention_masks.append(attention_mask)
-
-            sources = 1
-            features.append(
-            Input_SB_Features(input_ids=input_ids,
-                        attention_masks=attention_masks,
-                        token_type_ids=token_type_ids,
-                        relations=[0,0,0],
-                        doc_id=[int(doc_id)]*3,
-                        sen_id=[sen_id]*3,
-                        ids=ids,
-                        sources = [sources,sources,sources],
-                        rules = [0,0,0],
-                        ))
-            O_count+=3
-            O_red+=3
+    add_leftover_edges(assembler, BBB, BOB, OBB, OOO, B_rel, O_rel, acrobat_encoder)
+    add_rule_triangles(assembler, BBB, BOB, OBB, OOO, encoder)
 
+    return sum_BBB, sum_BOB, sum_OBB, sum_OOO
 
-    # add triple for rules
-    B_count, O_count = add_rules(BBB, 1,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(BBB, 2,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(BOB, 3,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(BOB, 4,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(OBB, 5,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(OBB, 6,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
-    B_count, O_count = add_rules(OOO, 7,B_count, O_count, features,doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id)
 
-    return sum_BBB, sum_BOB, sum_OBB, sum_OOO
- 
+def add_leftover_edges(assembler, BBB, BOB, OBB, OOO, B_rel, O_rel, encoder):
+    '''
+    add the BEFORE edges, the same edges reversed as AFTER and the OVERLAP edges that are in no rule triangle
+    '''
+    B_x, B_y = B_rel.nonzero()
+    O_x, O_y = O_rel.nonzero()
+    B_cover, O_cover = rule_coverage(BBB, BOB, OBB, OOO, B_rel.n)
+    B_index = np.nonzero(~B_cover.get(B_x, B_y))[0]
+    O_index = np.nonzero(~O_cover.get(O_x, O_y))[0]
+    assembler.add_edges(B_x[B_index], B_y[B_index], 1, encoder)
+    assembler.add_edges(B_y[B_index], B_x[B_index], 2, encoder)
+    assembler.add_edges(O_x[O_index], O_y[O_index], 0, encoder)
 
 
-def add_rules(rule_tensor, rule, B_count, O_count, features, doc_id, sen_id,  pos_dict, texts, tokenizer, mask_padding_with_zero, max_length, pad_on_left, pad_token, pad_token_segment_id):
+def add_rule_triangles(assembler, BBB, BOB, OBB, OOO, encoder):
     '''
-    add rules with a int indicating which rule it belong
+    add a triple for every rule triangle, each triangle once forward and once reversed
     '''
+    for triangles, rules in [(BBB, (1, 2)), (BOB, (3, 4)), (OBB, (5, 6)), (OOO, (7,))]:
+        for rule in rules:
+            assembler.add_triangles(triangles, rule, encoder)
 
-    all_x, all_y, all_z = np.where(rule_tensor>0)
 
-    for i in range(all_x.shape[0]):
-        input_ids, token_type_ids, attention_masks = [], [], []
-        ids = [(all_x[i],all_y[i]), (all_y[i],all_z[i]), (all_x[i],all_z[i])] if rule not in [2,4,6] else [(all_z[i],all_y[i]), (all_y[i],all_x[i]), (all_z[i],all_x[i])]
-        for e1, e2 in ids:
-            x1, x2 = pos_dict[e1]
-            y1, y2 = pos_dict[e2]
-            if x1 > y1:
-                x1,x2,y1,y2 = y1,y2,x1,x2
-                new_text = texts[0:x1] + ['<e2>'] + texts[x1:(x2+1)] + ['</e2>'] + texts[(x2+1):y1] + ['<e1>'] + texts[y1:(y2+1)] + ['</e1>'] + texts[(y2+1):len(texts)]
-                new_text = ' '.join(new_text)
-            else:
-                new_text = texts[0:x1] + ['<e1>'] + texts[x1:(x2+1)] + ['</e1>'] + texts[(x2+1):y1] + ['<e2>'] + texts[y1:(y2+1)] + ['</e2>'] + texts[(y2+1):len(texts)]
-                new_text = ' '.join(new_text)
-            
-            inputs = tokenizer.encode_plus(
-                new_text,
-                add_special_tokens=True,
-                max_length=max_length,
-            )
-            node_pos_1 = node_pos_2 = -1
-            text = tokenizer.tokenize(new_text)
-            for j in range(len(text)-4):
-                if text[:4] == ['[', 'e', '##1', ']']:
-                    node_pos_1 = j + 4
-                elif text[:4] == ['[', 'e', '##2', ']']:
-                    node_pos_2 = j + 4
+# encodings kept by a PairEncodingMemo, about 100 MB of 128-token rows
+PAIR_MEMO_SIZE = 1 << 16
 
-            input_id, token_type_id = inputs["input_ids"], inputs["token_type_ids"]
-            attention_mask = [1 if mask_padding_with_zero else 0] * len(input_id)
 
-            # Zero-pad up to the sequence length.
-            padding_length = max_length - len(input_id)
+class PairEncodingMemo(object):
+    """
+    LRU memo of the padded ``input_ids``, ``attention_mask``, ``token_type_ids`` and ``node_pos`` of a pair, keyed by
+    (doc_id, sen_id, x, y) and the joiner of the encoder, so the two ACROBAT encoders of a window do not
+    share entries. A pair referenced by many triples of a window is encoded once.
 
-            if pad_on_left:
-                input_id = ([pad_token] * padding_length) + input_id
-                attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                token_type_id = ([pad_token_segment_id] * padding_length) + token_type_id
-            else:
-                input_id = input_id + ([pad_token] * padding_length)
-                attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                token_type_id = token_type_id + ([pad_token_segment_id] * padding_length)
+    Args:
+        max_size: number of encodings kept; past it the least recently used one is evicted
+    """
+    def __init__(self, max_size = PAIR_MEMO_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, encoder, doc_id, sen_id, x, y):
+        key = (doc_id, sen_id, encoder.joiner, x, y)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = encoder.encode(x, y)
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+        return entry
+
+
+class TripleAssembler(object):
+    """
+    Assembles the triple features of one window into fixed-shape arrays.
 
-            assert len(input_id) == max_length, "Error with input length {} vs {}".format(len(input_id), max_length)
-            assert len(attention_mask) == max_length, "Error with input length {} vs {}".format(len(attention_mask), max_length)
-            assert len(token_type_id) == max_length, "Error with input length {} vs {}".format(len(token_type_id), max_length)
+    Blocks of triples are added as (k, 3) pairs of event indices with their labels and rule; ``arrays``
+    encodes every distinct pair of the window once, through ``memo``, into a table of pair rows that the
+    triples index, so a pair shared by several triples is stored once.
 
-            input_ids.append(input_id)
-            token_type_ids.append(token_type_id)
-            attention_masks.append(attention_mask)
+    Rules: 0 no rule, 1 BBB, 2 AAA, 3 BOB, 4 OAA, 5 OBB, 6 AOA, 7 OOO.
 
+    Args:
+        doc_id: document id of the window
+        sen_id: sentence id of the window, as in the examples
+        tbd: whether sen_id is a TB-Dense sentence id
+        memo: PairEncodingMemo shared by the windows of a run, a new one when None
+        skip: n*n mask of the pairs add_edges leaves out, kept in another window (``duplicate_pair_mask``)
+    """
+    def __init__(self, doc_id, sen_id, tbd = False, memo = None, skip = None):
+        self.doc_id = int(doc_id)
+        self.sen_key = sen_id
+        self.sen_id = parse_sen_id(sen_id, tbd)
+        self.memo = memo if memo is not None else PairEncodingMemo()
+        self.skip = skip
+        # (encoder, pairs (k, 3, 2), labels (k, 3), rules (k,), valid (k, 3)) in the order they are added
+        self.blocks = []
+
+    def __len__(self):
+        return sum(block[1].shape[0] for block in self.blocks)
+
+    def add_edges(self, x, y, label, encoder):
         '''
-        0:no rule
-        1:BBB
-        2:AAA
-        3:BOB
-        4:OAA
-        5:OBB
-        6:AOA
-        7:OOO
+        the edges (x[i], y[i]) of one label, three by three in order; the last triple is filled up with the
+        first edge and the filler rows are not valid; the pairs of skip are left out
         '''
-        relations = {
-            1: [1,1,1],
-            2: [2,2,2],
-            3: [1,0,1],
-            4: [0,2,2],
-            5: [0,1,1],
-            6: [2,0,2],
-            7: [0,0,0],
-        }
-
-        sources = 1
-        features.append(
-        Input_SB_Features(input_ids=input_ids,
-                    attention_masks=attention_masks,
-                    token_type_ids=token_type_ids,
-                    #matrix=example.matrix,
-                    relations=relations[rule],
-                    doc_id=[int(doc_id)]*3,
-                    sen_id=[sen_id]*3,
-                    ids=ids,
-                    sources = [sources,sources,sources],
-                    rules = [rule]*3,
-                    #node_pos = (node_pos_1, node_pos_2),
-                    ))
-        if rule in [1,2]:
-            B_count+=3
-        if rule in [3,4]:
-            B_count+=2
-            O_count+=1
-        if rule in [5,6]:
-            B_count+=1
-            O_count+=2
-        if rule == 7:
-            O_count+=3
-            
-    return B_count, O_count
+        if self.skip is not None:
+            keep = ~self.skip[np.asarray(x, dtype = np.int64), np.asarray(y, dtype = np.int64)]
+            x, y = np.asarray(x)[keep], np.asarray(y)[keep]
+        n = len(x)
+        if n == 0:
+            return
+        k = -(-n // 3)
+        rows = np.zeros(3 * k, dtype = np.int64)
+        rows[:n] = np.arange(n)
+        pairs = np.stack([np.asarray(x)[rows], np.asarray(y)[rows]], axis = 1).reshape(k, 3, 2)
+        valid = (np.arange(3 * k) < n).reshape(k, 3)
+        self.blocks.append((encoder, pairs, np.full((k, 3), label), np.zeros(k, dtype = np.int64), valid))
+
+    def add_triangles(self, triangles, rule, encoder):
+        '''
+        the (x, y, z) rows of rule_triangles as triples (x-y, y-z, x-z) of the rule; the reversed rules 2, 4
+        and 6 take (z-y, y-x, z-x)
+        '''
+        k = triangles.shape[0]
+        if k == 0:
+            return
+        x, y, z = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        if rule in [2, 4, 6]:
+            x, z = z, x
+        pairs = np.stack([np.stack([x, y], axis = 1), np.stack([y, z], axis = 1), np.stack([x, z], axis = 1)], axis = 1)
+        self.blocks.append((encoder, pairs, np.tile(RULE_LABELS[rule], (k, 1)), np.full(k, rule), np.ones((k, 3), dtype = bool)))
+
+    def arrays(self):
+        '''
+        the columns of the triples, named as in features_to_columns: input_ids, attention_mask, token_type_ids
+        and node_pos have a row per distinct pair and encoder, triple_pairs the (k, 3) rows of the triples
+        '''
+        dtypes = {name: dtype for name, _, dtype in FEATURE_COLUMNS}
+        k = len(self)
+        columns = {'triple_pairs': np.empty((k, 3), dtype = dtypes['triple_pairs'])}
+        starts = np.cumsum([0] + [block[1].shape[0] for block in self.blocks])
+        encoded = []
+
+        encoders = []
+        for block in self.blocks:
+            if not any(block[0] is encoder for encoder in encoders):
+                encoders.append(block[0])
+        for encoder in encoders:
+            # every distinct pair of the blocks of this encoder is encoded once
+            index = [i for i, block in enumerate(self.blocks) if block[0] is encoder]
+            pairs = np.concatenate([self.blocks[i][1].reshape(-1, 2) for i in index])
+            unique, inverse = np.unique(pairs, axis = 0, return_inverse = True)
+            rows = inverse.reshape(-1) + len(encoded)
+            encoded.extend(self.memo.encode(encoder, self.doc_id, self.sen_key, int(x), int(y)) for x, y in unique)
+            offset = 0
+            for i in index:
+                size = self.blocks[i][1].shape[0]
+                columns['triple_pairs'][starts[i]:starts[i + 1]] = rows[offset:offset + 3 * size].reshape(size, 3)
+                offset += 3 * size
+        for j, name in enumerate(['input_ids', 'attention_mask', 'token_type_ids', 'node_pos']):
+            columns[name] = np.asarray([e[j] for e in encoded], dtype = dtypes[name])
+
+        columns['event_ids'] = np.concatenate([block[1] for block in self.blocks]).astype(dtypes['event_ids'])
+        columns['labels'] = np.concatenate([block[2] for block in self.blocks]).astype(dtypes['labels'])
+        columns['doc_ids'] = np.full((k, 3), self.doc_id, dtype = dtypes['doc_ids'])
+        columns['sen_ids'] = np.tile(np.asarray(self.sen_id, dtype = dtypes['sen_ids']), (k, 3, 1))
+        columns['rules'] = np.repeat(np.concatenate([block[3] for block in self.blocks])[:, None], 3, axis = 1).astype(dtypes['rules'])
+        columns['valid'] = np.concatenate([block[4] for block in self.blocks]).astype(dtypes['valid'])
+        return columns
 
 
 def rule_tensor(A, B):
@@ -2460,7 +2520,7 @@ def build_rules(rule = None, rule_tensor = None, n_rule = None):
     return emb, labels
 
 
-def iter_rule_update(BM= None, OM=None,  n_iter= 3,  wrong_count=None, evaluate=False):
+def iter_rule_update(BM= None, OM=None,  n_iter= 3,  wrong_count=None, evaluate=False, closure=None):
     '''
     iteratively find the ground truth by applying rules
     rules: 
@@ -2469,85 +2529,44 @@ def iter_rule_update(BM= None, OM=None,  n_iter= 3,  wrong_count=None, evaluate=
     if Bij Bjk, then Bik
     if Oij Ojk, then Oik
     if Oij, then Oji
+    n_iter caps the number of rounds, a negative n_iter gives the exact closure (see temporal_closure);
+    OVERLAP is always treated as symmetric. Contradictory windows keep their original relations.
+    closure is the precomputed window_closure of the window, which is then only filtered to n_iter rounds
     '''
-    # first complete OM
-    OOM = np.copy(OM) 
-    OBM = np.copy(BM)
-    if not evaluate:
-        OM = OM + OM.transpose()
-    #OM = OM + np.matmul(OM, OM)
-
-    # iteratively update BM
-    for _ in range(n_iter):
-        new_BM = BM + np.matmul(BM, OM)
-        new_BM = new_BM + np.matmul(OM, BM)
-        new_BM = new_BM + np.matmul(BM, BM)
-        OM = OM + np.matmul(OM, OM)
-        new_BM[np.where(new_BM>0)] = 1
-        BM = new_BM
-    
-    # normalize
-    BM[np.where(BM>0)] = 1
-    OM[np.where(OM>0)] = 1
-
-    for i in range(OM.shape[0]):
-        OM[i,i] = 0
-
-    if judge_rule(BM):
+    if closure is None:
+        closed_BM, closed_OM, consistent = capped_closure(BM, OM, n_iter)
+    else:
+        closed_BM, closed_OM, consistent = closure_at_round(closure, n_iter)
+    if not consistent:
         wrong_count+=1
-        OM = OOM
-        BM = OBM
-           
+        return BM, OM, wrong_count
 
-    return BM, OM, wrong_count
+    return closed_BM, closed_OM, wrong_count
 
 
 
-def iter_rule_update_tbd(BM= None, OM=None, IM=None, VM=None  ,n_iter= 3,  wrong_count=None, evaluate=False):
+def iter_rule_update_tbd(BM= None, OM=None, IM=None, VM=None  ,n_iter= 3,  wrong_count=None, evaluate=False, closure=None):
     '''
-    iteratively find the ground truth by applying rules
-    rules: 
-    if Bij Ojk, then Bik
-    if Oij Bjk, then Bik
+    iteratively find the ground truth of the TB-Dense relations by path consistency over the six labels
+    (see temporal_closure.TBD_COMPOSITION), e.g.
     if Bij Bjk, then Bik
-    if Oij Ojk, then Oik
-    if Oij, then Oji
+    if Bij INCLUDESjk, then Bik
+    if IS_INCLUDEDij Bjk, then Bik
+    if INCLUDESij INCLUDESjk, then INCLUDESik
+    if SIMULTANEOUSij Rjk, then Rik
+    n_iter caps the number of rounds, a negative n_iter runs to the fixpoint; VAGUE pairs keep their label.
+    Contradictory windows keep their original relations.
+    closure is the precomputed window_closure of the window, which is then only filtered to n_iter rounds
     '''
-    # first complete OM
-    OOM = np.copy(OM) 
-    OBM = np.copy(BM)
-    if not evaluate:
-        OM = OM + OM.transpose()
-        #VM = VM + VM.transpose()
-    #OM = OM + np.matmul(OM, OM)
-
-    # iteratively update BM
-    for _ in range(n_iter):
-        #new_BM = BM + np.matmul(BM, OM)
-        #new_BM = new_BM + np.matmul(OM, BM)
-        #new_BM = new_BM + np.matmul(BM, BM)
-        new_BM = BM + np.matmul(BM,BM)
-        #OM = OM + np.matmul(OM, OM)
-        new_BM[np.where(new_BM>0)] = 1
-        BM = new_BM
-        
-    # normalize
-    BM[np.where(BM>0)] = 1
-    OM[np.where(OM>0)] = 1
-    IM[np.where(IM>0)] = 1
-    VM[np.where(VM>0)] = 1
-    
-
-    for i in range(OM.shape[0]):
-        OM[i,i] = 0
-
-    if judge_rule(BM):
+    if closure is None:
+        closed_BM, closed_OM, closed_IM, consistent = tbd_closure(BM, OM, IM, VM, n_iter)
+    else:
+        closed_BM, closed_OM, closed_IM, consistent = tbd_closure_at_round(closure, VM, n_iter)
+    if not consistent:
         wrong_count+=1
-        OM = OOM
-        BM = OBM
-           
+        return BM, OM, IM, VM, wrong_count
 
-    return BM, OM, IM, VM, wrong_count
+    return closed_BM, closed_OM, closed_IM, VM, wrong_count
 
 def reduce_rule(BM, OM, remove_count):
     '''
@@ -2579,6 +2598,39 @@ def rule_tensor(A, B):
     
     return C
 
+def rule_triangles(A, B, C):
+    '''
+    (x, y, z) rows where Axy, Byz and Cxz are all set (RelationMatrix), in the order of
+    np.where(rule_tensor(A, B) * Cxz > 0). The 2-paths of A then B are enumerated from the row offsets of B,
+    so memory is O(edges + paths) instead of the dense n*n*n tensor
+    '''
+    x, y = A.nonzero()
+    B_src, B_dst = B.nonzero()
+    B_row = np.searchsorted(B_src, np.arange(A.n + 1))
+    start, count = B_row[y], B_row[y + 1] - B_row[y]
+    total = int(count.sum())
+    # position of every path inside its B row
+    step = np.arange(total) - np.repeat(np.cumsum(count) - count, count)
+    x, y = np.repeat(x, count), np.repeat(y, count)
+    z = B_dst[np.repeat(start, count) + step]
+    keep = C.get(x, z)
+    return np.stack((x[keep], y[keep], z[keep]), axis = 1)
+
+def rule_coverage(BBB, BOB, OBB, OOO, n):
+    '''
+    RelationMatrix of the BEFORE and OVERLAP pairs used by a rule triple, each pair only counts in the role
+    the rule gives it; OVERLAP is symmetric so its relation is too
+    '''
+    pairs = {'B': ([], []), 'O': ([], [])}
+    for triangles, roles in [(BBB, 'BBB'), (BOB, 'BOB'), (OBB, 'OBB'), (OOO, 'OOO')]:
+        x, y, z = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        for (i, j), role in zip([(x, y), (y, z), (x, z)], roles):
+            pairs[role][0].append(i)
+            pairs[role][1].append(j)
+    B_cover = RelationMatrix.from_pairs(n, np.concatenate(pairs['B'][0]), np.concatenate(pairs['B'][1]))
+    O_cover = RelationMatrix.from_pairs(n, np.concatenate(pairs['O'][0]), np.concatenate(pairs['O'][1]))
+    return B_cover, O_cover | O_cover.T
+
 def reverse(r):
     # reverse TLINK
     if r == 0:
@@ -2607,59 +2659,58 @@ def IDIndexDic(rel = None):
         rd[i] = iid[1]
     return d,rd
 
+# label code of each relation string, the label ids of the model; other relations get -1
+I2B2_RELATION_CODES = {'OVERLAP': 0, 'BEFORE': 1, 'AFTER': 2}
+TBD_RELATION_CODES = {label: code for code, label in enumerate(TBD_LABELS)}
+# AFTER and IS_INCLUDED are the transpose of BEFORE and INCLUDES
+TRANSPOSED_CODES = np.array([0, 1, 1, 3, 4, 4])
+TRANSPOSED = np.array([False, False, True, False, False, True])
+
+def relation_arrays(rel = None, IDToIndex= None, tbd = False):
+    '''
+    convert the relations to integer arrays of source index, target index and label code,
+    and the word span of every event
+    '''
+    codes = TBD_RELATION_CODES if tbd else I2B2_RELATION_CODES
+    src = np.array([IDToIndex[r[2]] for r in rel], dtype=np.int64)
+    dst = np.array([IDToIndex[r[5]] for r in rel], dtype=np.int64)
+    code = np.array([codes.get(r[6], -1) for r in rel], dtype=np.int64)
+    pos_dict = {}
+    for r in rel:
+        pos_dict[IDToIndex[r[2]]] = (r[0],r[1])
+        pos_dict[IDToIndex[r[5]]] = (r[3],r[4])
+    return src, dst, code, pos_dict
+
+def relation_layers(n, src, dst, code, transpose = False):
+    '''
+    (6, n, n) 0/1 matrices, layer l holds the pairs with label code l; with transpose the AFTER and
+    IS_INCLUDED pairs are stored transposed in the BEFORE and INCLUDES layers.
+    Also returns IDM, where only IS_INCLUDED is transposed
+    '''
+    keep = code >= 0
+    src, dst, code = src[keep], dst[keep], code[keep]
+    flip = TRANSPOSED[code]
+    layers = np.zeros((6, n, n))
+    if transpose:
+        layers[TRANSPOSED_CODES[code], np.where(flip, dst, src), np.where(flip, src, dst)] = 1
+    else:
+        layers[code, src, dst] = 1
+    IDM = np.zeros((n,n))
+    is_included = code == 5
+    IDM[np.where(is_included, dst, src), np.where(is_included, src, dst)] = 1
+    return layers, IDM
+
 def build_BO(rel = None, IDToIndex= None, tbd = False):
     '''
     convert the relations to before matrix and overlap matrix, not distinguished before and after
     later will construct after matrix by transverse
     '''
-    n = len(IDToIndex)
-    BM = np.zeros((n,n))
-    OM = np.zeros((n,n))
-    IDM = np.zeros((n,n))
-    VM = np.zeros((n,n))
+    src, dst, code, pos_dict = relation_arrays(rel, IDToIndex, tbd)
+    layers, IDM = relation_layers(len(IDToIndex), src, dst, code, transpose = True)
+    BM, OM, VM = layers[1], layers[0], layers[3]
     if tbd:
-        IM = np.zeros((n,n))
-        
-    pos_dict = {}
-    if tbd:
-        for r in rel:
-            pos_dict[IDToIndex[r[2]]] = (r[0],r[1])
-            pos_dict[IDToIndex[r[5]]] = (r[3],r[4])
-            if r[6] == "SIMULTANEOUS":
-                OM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "BEFORE":
-                BM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "AFTER":
-                BM[IDToIndex[r[5]],IDToIndex[r[2]]] = 1 
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "VAGUE":
-                VM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "INCLUDES":
-                IM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "IS_INCLUDED":
-                IM[IDToIndex[r[5]],IDToIndex[r[2]]] = 1
-                IDM[IDToIndex[r[5]],IDToIndex[r[2]]] = 1
+        IM = layers[4]
         return BM,OM, IDM, pos_dict, VM, IM
-                
-            
-
-    else:
-        for r in rel:
-            pos_dict[IDToIndex[r[2]]] = (r[0],r[1])
-            pos_dict[IDToIndex[r[5]]] = (r[3],r[4])
-            if r[6] == "OVERLAP":
-                OM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "BEFORE":
-                BM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "AFTER":
-                BM[IDToIndex[r[5]],IDToIndex[r[2]]] = 1 
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
     return BM, OM, IDM, pos_dict, VM
 
 
@@ -2668,56 +2719,12 @@ def build_BO_evaluate(rel = None, IDToIndex= None, tbd = False):
     convert the relations to before matrix and overlap matrix, not distinguished before and after
     later will construct after matrix by transverse
     '''
-    n = len(IDToIndex)
-    BM = np.zeros((n,n))
-    AM = np.zeros((n,n))
-    OM = np.zeros((n,n))
-    IDM = np.zeros((n,n))
-    VM = np.zeros((n,n))
-    
-    if tbd:
-        IM = np.zeros((n,n))
-        TIM = np.zeros((n,n))
-    pos_dict = {}
+    src, dst, code, pos_dict = relation_arrays(rel, IDToIndex, tbd)
+    layers, IDM = relation_layers(len(IDToIndex), src, dst, code)
+    BM, AM, OM, VM = layers[1], layers[2], layers[0], layers[3]
     if tbd:
-        for r in rel:
-            pos_dict[IDToIndex[r[2]]] = (r[0],r[1])
-            pos_dict[IDToIndex[r[5]]] = (r[3],r[4])
-            if r[6] == "SIMULTANEOUS":
-                OM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "BEFORE":
-                BM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "AFTER":
-                AM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1 
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "VAGUE":
-                VM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "INCLUDES":
-                IM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "IS_INCLUDED":
-                TIM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[5]],IDToIndex[r[2]]] = 1
+        IM, TIM = layers[4], layers[5]
         return BM,AM, OM, IDM, pos_dict, VM, IM, TIM
-                
-            
-
-    else:
-        for r in rel:
-            pos_dict[IDToIndex[r[2]]] = (r[0],r[1])
-            pos_dict[IDToIndex[r[5]]] = (r[3],r[4])
-            if r[6] == "OVERLAP":
-                OM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "BEFORE":
-                BM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
-            if r[6] == "AFTER":
-                AM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1 
-                IDM[IDToIndex[r[2]],IDToIndex[r[5]]] = 1
     return BM,AM, OM, IDM, pos_dict, VM
 
 